@@ -22,6 +22,7 @@ from api.auth import bp_auth
 from api.core import bp_api
 from api.customization import bp_customization
 from api.dev import bp_dev
+from api.logic.core import invalidate_spend_catalog
 from api.merchant import bp_merchant
 from api.models import db, PushWallet, User, Role, UserRole, PushCampaign, OrderHistory, WebhookEvent, Recipient, \
     UserImage, CustomizationSetting, Product, Category, Shop
@@ -32,8 +33,11 @@ from api.swagger import bp_swagger
 from api.upload import bp_upload, images
 from api.webhooks import bp_webhooks
 from config import ADMIN_PASS, FlaskConfig, DEV
+from helpers.metrics import metrics
 from helpers.misc import setup_logging
 
+STATELESS_PATH_PREFIXES = ('/api/', '/webhooks/', '/swagger', '/static/')
+
 blueprints = [
     bp_auth,
     bp_api,
@@ -75,6 +79,11 @@ def app_init():
     configure_uploads(app, images)
     patch_request_class(app)
     db.init_app(app)
+    metrics.gauge('db_pool', lambda: {
+        'in_use': len(db.database._in_use),
+        'idle': len(db.database._connections),
+        'max': db.database._max_connections
+    })
 
     # Flask-Security setup
 
@@ -119,7 +128,10 @@ def app_init():
 
     @app.before_request
     def login_implicitly():
-        if isinstance(current_user._get_current_object(), AnonymousUser):
+        # anonymous user row is created only for pages which may need it (social auth binds to it),
+        # API clients, webhooks, tracking pixel, etc. stay sessionless
+        is_stateless = request.path.startswith(STATELESS_PATH_PREFIXES)
+        if not is_stateless and isinstance(current_user._get_current_object(), AnonymousUser):
             u = user_datastore.create_user(roles=['anonymous'])
             user_datastore.login_user_silent(u)
         g.user = current_user
@@ -151,15 +163,24 @@ def app_init():
                     abort(403)
                 return redirect(url_for('auth.admin_login', next=request.url))
 
+    class CatalogModelView(SecureModelView):
+        """ Changes of shops, products and categories invalidate /api/spend/list snapshot """
+
+        def after_model_change(self, form, model, is_created):
+            invalidate_spend_catalog()
+
+        def after_model_delete(self, model):
+            invalidate_spend_catalog()
+
     class AuthenticatedMenuLink(MenuLink):
 
         def is_accessible(self):
             return current_user.is_authenticated
 
     admin = Admin(app, name='pushmoney', template_mode='bootstrap3')
-    admin.add_view(SecureModelView(Shop))
-    admin.add_view(SecureModelView(Category))
-    admin.add_view(SecureModelView(Product))
+    admin.add_view(CatalogModelView(Shop))
+    admin.add_view(CatalogModelView(Category))
+    admin.add_view(CatalogModelView(Product))
     admin.add_view(SecureModelView(User))
     admin.add_view(SecureModelView(PushWallet))
     admin.add_view(SecureModelView(PushCampaign))
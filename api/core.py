@@ -1,16 +1,19 @@
-from datetime import datetime
+import hmac
 from http import HTTPStatus
 from flask import Blueprint, jsonify, request, url_for
-from mintersdk.sdk.wallet import MinterWallet
-from mintersdk.shortcuts import to_bip
+from flask_login import current_user
 from api.logic.core import generate_and_save_wallet, get_address_balance, spend_balance, \
-    get_spend_list
-from api.models import PushWallet, PushCampaign, Recipient, CustomizationSetting
+    get_spend_list, transfer_virtual_balance
+from api.models import PushWallet, CustomizationSetting, PendingPayout
+from config import METRICS_TOKEN
+from minter.api import MinterAPIException
+from minter.confirm import normalize_hash
 from minter.helpers import TxDeeplink
-from minter.tx import send_coin_tx, estimate_custom_fee
-from providers.currency_rates import bip_to_usdt, fiat_to_usd_rates
+from minter.tx import estimate_custom_fee
+from helpers.metrics import metrics
+from providers.currency_rates import bip_to_usdt, fiat_to_usd_rates, rates_age
 from providers.explorer import get_custom_coin_symbols
-from providers.minter import send_coins
+from providers.gift import gift_order_status
 from providers.nodeapi import NodeAPI
 
 bp_api = Blueprint('api', __name__, url_prefix='/api')
@@ -21,6 +24,16 @@ def health():
     return f'Api ok. <a href="{url_for("swagger.swag")}">Swagger</a>'
 
 
+@bp_api.route('/metrics', methods=['GET'])
+def metrics_snapshot():
+    token = request.headers.get('Authorization', '')
+    has_token = bool(METRICS_TOKEN) and hmac.compare_digest(token, f'Bearer {METRICS_TOKEN}')
+    is_admin = current_user.is_authenticated and current_user.has_role('superuser')
+    if not has_token and not is_admin:
+        return jsonify({'error': 'Unauthorized'}), HTTPStatus.UNAUTHORIZED
+    return jsonify(metrics.snapshot())
+
+
 @bp_api.route('/custom-coins')
 def custom_coins():
     return jsonify({"symbols": get_custom_coin_symbols()})
@@ -34,7 +47,9 @@ def exchange_rates():
         currency: 1 / (usd_value * bip_usd_price)
         for currency, usd_value in fiat_usd.items() if currency in ['USD', 'UAH', 'EUR', 'RUB']
     }}
-    return jsonify(x2bip)
+    response = jsonify(x2bip)
+    response.headers['X-Rates-Age'] = str(int(rates_age()))
+    return response
 
 
 @bp_api.route('/deeplink')
@@ -65,6 +80,44 @@ def deeplink():
     }
 
 
+@bp_api.route('/tx/<tx_hash>', methods=['GET'])
+def tx_status(tx_hash):
+    pending = NodeAPI.tracker.get(tx_hash)
+    if pending:
+        return jsonify(pending.to_dict())
+
+    # tx was sent by another worker or is already forgotten - ask node directly
+    tx_hash = normalize_hash(tx_hash)
+    try:
+        tx = NodeAPI.get_transaction(tx_hash)
+    except MinterAPIException:
+        return jsonify({'hash': 'Mt' + tx_hash, 'status': 'pending'})
+    code = int(tx.get('code') or 0)
+    return jsonify({
+        'hash': 'Mt' + tx_hash,
+        'status': 'confirmed' if code == 0 else 'failed',
+        'block': int(tx['height']),
+        'code': code,
+        'log': tx.get('log')
+    })
+
+
+@bp_api.route('/spend/gift/<order_id>', methods=['GET'])
+def gift_order(order_id):
+    """
+    swagger: swagger/core/gift-order.yml
+    """
+    return jsonify(gift_order_status(order_id))
+
+
+@bp_api.route('/payout/<int:payout_id>', methods=['GET'])
+def payout_status(payout_id):
+    payout = PendingPayout.get_or_none(id=payout_id)
+    if not payout:
+        return jsonify({'error': 'Payout not found'}), HTTPStatus.NOT_FOUND
+    return jsonify({'status': payout.status, 'tx_hash': payout.tx_hash})
+
+
 @bp_api.route('/push/create', methods=['POST'])
 def push_create():
     """
@@ -89,9 +142,7 @@ def push_create():
         'link_id': wallet.link_id
     }
     if amount:
-        w = MinterWallet.create()
-        tx = send_coin_tx(w['private_key'], coin, float(amount), w['address'], 1, gas_coin=coin)
-        tx_fee = float(to_bip(NodeAPI.estimate_tx_comission(tx.signed_tx)['commission']))
+        tx_fee = float(estimate_custom_fee(coin) or 0)
         response['deeplink'] = TxDeeplink.create('send', to=wallet.address, value=float(amount) + tx_fee, coin=coin).mobile
     return jsonify(response)
 
@@ -144,31 +195,15 @@ def push_balance(link_id):
     if not wallet.auth(password):
         return jsonify({'error': 'Incorrect password'}), HTTPStatus.UNAUTHORIZED
 
-    # зарефакторить
     virtual_balance = None if wallet.virtual_balance == '0' else wallet.virtual_balance
     if virtual_balance is not None and not wallet.seen:
-        if wallet.sent_from:
-            from_w = PushWallet.get(link_id=wallet.sent_from)
-            result = send_coins(from_w, wallet.address, amount=to_bip(wallet.virtual_balance), wait=False)
-            if result is not True:
-                return jsonify({'error': result}), HTTPStatus.INTERNAL_SERVER_ERROR
-            wallet.virtual_balance = '0'
-            wallet.save()
-        else:
-            cmp = PushCampaign.get_or_none(id=wallet.campaign_id)
-            cmp_wallet = PushWallet.get(link_id=cmp.wallet_link_id)
-            result = send_coins(cmp_wallet, wallet.address, amount=to_bip(wallet.virtual_balance), wait=False)
-            if result is not True:
-                return jsonify({'error': result}), HTTPStatus.INTERNAL_SERVER_ERROR
-            wallet.virtual_balance = '0'
-            recipient = Recipient.get(wallet_link_id=wallet.link_id)
-            recipient.linked_at = datetime.utcnow()
-            recipient.save()
-            wallet.save()
+        error = transfer_virtual_balance(wallet)
+        if error:
+            return jsonify({'error': error}), HTTPStatus.INTERNAL_SERVER_ERROR
 
     if not wallet.seen:
         wallet.seen = True
-        wallet.save()
+        wallet.save(only=[PushWallet.seen])
     balance = get_address_balance(wallet.address, virtual=virtual_balance)
     response = {
         'address': wallet.address,
@@ -183,7 +218,9 @@ def spend_options():
     swagger: swagger/core/spend-list.yml
     """
     categories = get_spend_list()
-    return jsonify(categories)
+    response = jsonify(categories)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @bp_api.route('/spend/<link_id>', methods=['POST'])
@@ -216,7 +253,7 @@ def make_spend(link_id):
     if slug == 'resend':
         params['new_password'] = new_password
 
-    result = spend_balance(wallet, slug, confirm=confirm, **params)
+    result = spend_balance(wallet, slug, confirm=confirm, quote_id=payload.get('quote_id'), **params)
     if isinstance(result, str):
         return jsonify({'success': False, 'error': result}), HTTPStatus.INTERNAL_SERVER_ERROR
 
@@ -1,47 +1,108 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from decimal import Decimal
 from functools import partial
+from threading import Lock
 
 from mintersdk.sdk.wallet import MinterWallet
 from mintersdk.shortcuts import to_pip, to_bip
 from passlib.handlers.pbkdf2 import pbkdf2_sha256
+from peewee import fn
 
-from helpers.misc import truncate, uuid
+from api.logic.quotes import create_quote, use_quote, QUOTE_TTL
+from helpers import shared_cache
+from helpers.link_id import create_with_link_id, bulk_create_with_link_ids
+from helpers.misc import truncate
+from helpers.shared_cache import SharedValue
 from helpers.url import make_icon_url
-from minter.helpers import effective_balance, effective_value
+from minter.confirm import PendingTx
+from minter.helpers import valuate_balances
+from minter.keys import encrypt_private_key, create_wallet_keys
 from providers.currency_rates import bip_to_usdt, fiat_to_usd_rates
-from api.models import PushWallet, Category, Shop
+from api.models import db, PushWallet, PushCampaign, Recipient, Category, Shop, Product
 from providers.flatfm import flatfm_top_up
 from providers.gift import gift_buy
 from providers.giftery import giftery_buy
 from providers.gratz import gratz_buy
-from providers.minter import send_coins
+from providers.minter import send_coins, SpendContext, PayoutSource, enqueue_payout
 from providers.nodeapi import NodeAPI
 from providers.biptophone import mobile_top_up
 from providers.timeloop import timeloop_top_up, bipgame_top_up
 from providers.unu import unu_top_up
 from providers.currency_rates import bip_price
 
+SPEND_CATALOG_KEY = 'spend-catalog'
+# below this number wallets are derived in-process, process pool is not worth it
+WALLET_POOL_THRESHOLD = 50
+WALLET_POOL_SIZE = min(4, os.cpu_count() or 1)
+
+_wallet_pool = None
+_wallet_pool_pid = None
+_wallet_pool_lock = Lock()
+
 
 def generate_and_save_wallet(**kwargs):
     password = kwargs.pop('password', None)
     password_hash = pbkdf2_sha256.hash(password) if password is not None else None
 
-    link_id = uuid(unique_for_model=PushWallet, model_param='link_id')
     wallet = MinterWallet.create()
-    return PushWallet.create(
-        link_id=link_id,
+    return create_with_link_id(
+        PushWallet,
         address=wallet['address'],
         mnemonic=wallet['mnemonic'],
+        private_key_enc=encrypt_private_key(wallet['private_key']),
         password_hash=password_hash, **kwargs)
 
 
+def wallet_pool():
+    """
+    Process pool for wallet generation, created once per gunicorn worker.
+    Processes are spawned, not forked: worker runs threads (scheduler, tx tracker, pg listener)
+    and a fork could copy a lock held by one of them into the child.
+    """
+    global _wallet_pool, _wallet_pool_pid
+    with _wallet_pool_lock:
+        if _wallet_pool is None or _wallet_pool_pid != os.getpid():
+            _wallet_pool = ProcessPoolExecutor(
+                max_workers=WALLET_POOL_SIZE, mp_context=multiprocessing.get_context('spawn'))
+            _wallet_pool_pid = os.getpid()
+        return _wallet_pool
+
+
+def generate_minter_wallets(count):
+    """ Mnemonic generation and key derivation are CPU bound, so large batches go to process pool """
+    if count < WALLET_POOL_THRESHOLD:
+        return [create_wallet_keys() for _ in range(count)]
+    return list(wallet_pool().map(create_wallet_keys, range(count), chunksize=64))
+
+
+def generate_and_save_wallets(wallets_kwargs, password=None, password_hash=None, **common_kwargs):
+    """
+    Bulk version of generate_and_save_wallet.
+    :param wallets_kwargs: list of per-wallet PushWallet fields
+    :param password: password shared by all wallets, hashed once
+    :param password_hash: already hashed shared password
+    """
+    if password is not None:
+        password_hash = pbkdf2_sha256.hash(password)
+    minter_wallets = generate_minter_wallets(len(wallets_kwargs))
+
+    wallets = [
+        PushWallet(
+            address=address, mnemonic=mnemonic, private_key_enc=encrypt_private_key(private_key),
+            password_hash=password_hash, **common_kwargs, **kwargs)
+        for (address, mnemonic, private_key), kwargs in zip(minter_wallets, wallets_kwargs)
+    ]
+    with db.database.atomic():
+        return bulk_create_with_link_ids(PushWallet, wallets)
+
+
 def get_address_balance(address, virtual=None):
-    if virtual:
-        balances = {'BIP': virtual}
-        balances_bip = {'BIP': Decimal(to_bip(virtual))}
-    else:
-        balances = NodeAPI.get_balance(address)['balance']
-        balances_bip = effective_balance(balances)
+    balances = {'BIP': virtual} if virtual else NodeAPI.get_balance(address)['balance']
+    valuation = valuate_balances(balances)
+    balances_bip = {'BIP': Decimal(to_bip(virtual))} if virtual else valuation.balances_bip
 
     main_coin, main_balance_bip = max(balances_bip.items(), key=lambda i: i[1])
     bip_value_total = truncate(float(main_balance_bip), 4)
@@ -51,7 +112,7 @@ def get_address_balance(address, virtual=None):
     local_fiat = 'RUB'
     local_fiat_value = truncate(usd_value_total * usd_rates[local_fiat], 4)
     coin_value = to_bip(balances[main_coin])
-    coin_value = truncate(float(effective_value(coin_value, main_coin)), 4)
+    coin_value = truncate(float(valuation.effective_value(coin_value, main_coin)), 4)
     return {
         'balance': {
             'coin': main_coin,
@@ -68,10 +129,56 @@ def get_address_balance(address, virtual=None):
     }
 
 
+def claim_virtual_balance(wallet):
+    """ Take virtual balance of the link, only one of concurrent requests gets it """
+    claimed = PushWallet \
+        .update(virtual_balance='0') \
+        .where((PushWallet.id == wallet.id) & (PushWallet.virtual_balance == wallet.virtual_balance)) \
+        .execute()
+    return bool(claimed)
+
+
+def transfer_virtual_balance(wallet):
+    """
+    Virtual balance becomes real when the link is opened first time.
+    :return: error message or None (also when balance was taken by concurrent request)
+    """
+    amount = to_bip(wallet.virtual_balance)
+    if wallet.sent_from:
+        if not claim_virtual_balance(wallet):
+            return
+        from_w = PushWallet.get(link_id=wallet.sent_from)
+        result = send_coins(from_w, wallet.address, amount=amount, wait=False)
+        if isinstance(result, str):
+            # nothing is sent, balance is given back to the link
+            PushWallet \
+                .update(virtual_balance=wallet.virtual_balance) \
+                .where((PushWallet.id == wallet.id) & (PushWallet.virtual_balance == '0')) \
+                .execute()
+            return result
+        return
+
+    cmp = PushCampaign.get_or_none(id=wallet.campaign_id)
+    cmp_wallet = PushWallet.get(link_id=cmp.wallet_link_id)
+    source = PayoutSource(cmp_wallet.address)
+    with db.database.atomic() as txn:
+        if not claim_virtual_balance(wallet):
+            return
+        # campaign recipients are funded in multisend batches (see jobs.payouts)
+        payout = enqueue_payout(source, wallet.address, amount)
+        if isinstance(payout, str):
+            txn.rollback()
+            return payout
+        Recipient \
+            .update(linked_at=datetime.utcnow()) \
+            .where(Recipient.wallet_link_id == wallet.link_id) \
+            .execute()
+
+
 def push_resend(
         wallet,
         new_password=None, sender=None, recipient=None, amount=None,
-        virtual=None):
+        virtual=None, ctx=None):
     if not amount:
         return 'Amount should be >0'
     virtual_balance = str(to_pip(amount)) if virtual else None
@@ -79,22 +186,25 @@ def push_resend(
         sender=sender, recipient=recipient, new_password=new_password,
         virtual_balance=virtual_balance, sent_from=wallet.link_id)
     if not virtual:
-        result = send_coins(wallet, new_wallet.address, amount, wait=True)
+        result = send_coins(wallet, new_wallet.address, amount, wait=False, ctx=ctx)
         if isinstance(result, str):
             return result
+        return {'new_link_id': new_wallet.link_id, 'tx': result.to_dict()}
     return {'new_link_id': new_wallet.link_id}
 
 
-def spend_balance(wallet: PushWallet, slug, confirm=True, **kwargs):
+def spend_balance(wallet: PushWallet, slug, confirm=True, quote_id=None, **kwargs):
     spend_option_fns = {
         'mobile': mobile_top_up,
-        'transfer-minter': send_coins,
+        'transfer-minter': partial(send_coins, wait=False),
         'resend': push_resend,
         'unu': unu_top_up,
         'timeloop': timeloop_top_up,
         'bipgame': bipgame_top_up,
         'flatfm': flatfm_top_up
     }
+    # params as requested by client, quote is bound to them
+    params = dict(kwargs)
     fn = spend_option_fns.get(slug)
     if slug not in ['transfer-minter', 'resend', 'timeloop', 'unu', 'bipgame', 'flatfm']:
         kwargs['confirm'] = confirm
@@ -112,10 +222,21 @@ def spend_balance(wallet: PushWallet, slug, confirm=True, **kwargs):
 
     if not fn:
         return 'Spend option is not supported yet'
-    return fn(wallet, **kwargs)
+    if confirm and quote_id:
+        quote = use_quote(quote_id, wallet, slug, params)
+        if isinstance(quote, str):
+            return quote
+        kwargs['quote'] = quote
+    # balance, nonce and fees are resolved once and shared by every step of the spend
+    result = fn(wallet, ctx=SpendContext(wallet), **kwargs)
+    if isinstance(result, dict) and 'quote' in result:
+        result['quote_id'] = create_quote(wallet, slug, params, result.pop('quote'))
+        result['quote_ttl'] = QUOTE_TTL
+    return {'tx': result.to_dict()} if isinstance(result, PendingTx) else result
 
 
-def get_spend_list():
+def build_spend_catalog():
+    """ Everything for /api/spend/list except live BIP price, built with a few queries """
     _top_shop_names = ['Яндекс.Еда', 'Перекресток', 'okko.tv']
     _top_shops = [s for s in Shop.select(Shop.id, Shop.name).where(Shop.name.in_(_top_shop_names))]
     _top_shop_slugs = [s.slug for s in _top_shops]
@@ -194,23 +315,33 @@ def get_spend_list():
             'icon_fav': make_icon_url('shop', 'bipgame_fav')
         }
     }
-    bip_coin_price = bip_price()
+    cat_shops = {}
+    for shop in Shop \
+            .select(Shop, Category) \
+            .join(Category) \
+            .where(Shop.active & ~Shop.deleted & ~(Category.slug % '%,%')) \
+            .order_by(Shop.id):
+        cat_shops.setdefault(shop.category, []).append(shop)
+    all_shops = [shop for shops_ in cat_shops.values() for shop in shops_]
+    shop_reprs = Shop.bulk_api_repr(all_shops)
+    products_count = dict(Product
+                          .select(Product.shop, fn.COUNT(Product.id))
+                          .where(Product.shop.in_([shop.id for shop in all_shops] or [0]))
+                          .group_by(Product.shop)
+                          .tuples())
 
-    for category in Category.select().where(~Category.slug % '%,%'):
-        cat_shops = category.shops.where(Shop.active & ~Shop.deleted)
-        if not cat_shops:
-            continue
+    for category, category_shops in cat_shops.items():
         categories[category.slug] = {
             'title': {'ru': category.title, 'en': category.title_en},
             'color': '#' + (category.display_color or ''),
             'icon': category.icon_url,
         }
-        for shop in cat_shops:
-            if not shop.products.count():
+        for shop in category_shops:
+            if not products_count.get(shop.id):
                 continue
             certificates.setdefault(category.slug, {})
             certificates[category.slug].setdefault(shop.slug, [])
-            shop_repr = shop.api_repr
+            shop_repr = shop_reprs[shop.id]
             if not shop_repr:
                 continue
             certificates[category.slug][shop.slug] = shop_repr
@@ -225,6 +356,19 @@ def get_spend_list():
         'shops_top': shops_top,
         'certificates': certificates,
         'categories': categories,
-        'shops': shops,
-        'bip_coin_price': bip_coin_price
+        'shops': shops
+    }
+
+
+spend_catalog = SharedValue(SPEND_CATALOG_KEY, build_spend_catalog)
+
+
+def invalidate_spend_catalog():
+    shared_cache.invalidate(SPEND_CATALOG_KEY)
+
+
+def get_spend_list():
+    return {
+        **spend_catalog.get(),
+        'bip_coin_price': bip_price()
     }
@@ -0,0 +1,63 @@
+"""
+Spend quotes: price and destination resolved by `?confirm=0` request, reused by the confirming one.
+
+Quote id is signed (can't be forged or reused for other wallet/option/params) and expires in QUOTE_TTL.
+Quote itself is stored in shared cache, so confirmation may be handled by any worker.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from shortuuid import uuid
+
+from helpers import shared_cache
+
+QUOTE_TTL = 5 * 60
+QUOTE_KEY_PREFIX = 'quote:'
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='spend-quote')
+
+
+def _params_digest(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def create_quote(wallet, slug, params, quote):
+    """
+    Store provider quote, return quote id for the client
+    :param params: spend params of the quoted request, confirming request should have the same
+    """
+    key = uuid()
+    shared_cache.put(QUOTE_KEY_PREFIX + key, quote)
+    return _serializer().dumps({
+        'key': key, 'link_id': wallet.link_id, 'slug': slug, 'params': _params_digest(params)})
+
+
+def use_quote(quote_id, wallet, slug, params):
+    """
+    Take stored quote for confirmation. Quote can be used only once.
+    :return: quote dict or error message
+    """
+    try:
+        data = _serializer().loads(quote_id, max_age=QUOTE_TTL)
+    except SignatureExpired:
+        return 'Quote expired, request a new one'
+    except BadSignature:
+        return 'Invalid quote'
+    if data['link_id'] != wallet.link_id or data['slug'] != slug:
+        return 'Invalid quote'
+    if data.get('params') != _params_digest(params):
+        return 'Quote was requested with other params'
+
+    quote = shared_cache.pop(QUOTE_KEY_PREFIX + data['key'])
+    if quote is None:
+        return 'Quote already used'
+    return quote
+
+
+def delete_expired_quotes():
+    return shared_cache.delete_stale(QUOTE_KEY_PREFIX, datetime.utcnow() - timedelta(seconds=QUOTE_TTL))
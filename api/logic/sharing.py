@@ -1,13 +1,27 @@
+import logging
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from time import monotonic, sleep
+
 from gspread import Spreadsheet
 from passlib.handlers.pbkdf2 import pbkdf2_sha256
 from peewee import fn
 
-from api.logic.core import generate_and_save_wallet
-from api.models import PushCampaign, Recipient, PushWallet
+from api.logic.core import generate_and_save_wallet, generate_and_save_wallets
+from api.models import db, PushCampaign, Recipient, PushWallet, CampaignJob
+from helpers.heartbeat import Heartbeat
+from jobs.scheduler import scheduler
+from minter.helpers import TxDeeplink
 from mintersdk.shortcuts import to_pip, to_bip
 from providers.google_sheets import get_spreadsheet, parse_recipients
 from providers.minter import ensure_balance
 
+CAMPAIGN_JOB_CHUNK = 500
+# progress job with older heartbeat is considered abandoned by crashed worker
+CAMPAIGN_JOB_STALE = timedelta(minutes=2)
+# how long /create waits for the job before answering with job id only
+CAMPAIGN_JOB_WAIT = 10
+
 
 def get_google_sheet_data(sheet_url):
     spreadsheet_or_error = get_spreadsheet(sheet_url)
@@ -23,10 +37,7 @@ def get_google_sheet_data(sheet_url):
     return recipients, campaign_cost
 
 
-def create_campaign(
-        recipients, sender, cost,
-        campaign_pass=None, wallet_pass=None, target=None, customization_id=None):
-    campaign_pass_hash = pbkdf2_sha256.hash(campaign_pass) if campaign_pass is not None else None
+def create_campaign_record(sender, cost, campaign_pass_hash=None, customization_id=None):
     campaign_wallet = generate_and_save_wallet()
     campaign = PushCampaign.create(
         wallet_link_id=campaign_wallet.link_id,
@@ -35,21 +46,154 @@ def create_campaign(
         company=sender,
         password_hash=campaign_pass_hash,
         customization_setting_id=customization_id)
+    return campaign, campaign_wallet
+
 
-    for info in recipients.values():
-        balance = str(to_pip(info['amount'] + 0.01))
-        wallet = generate_and_save_wallet(
-            sender=sender, recipient=info['name'], password=wallet_pass,
-            campaign_id=campaign.id, virtual_balance=balance,
+def create_campaign_recipients(
+        campaign, recipients, sender, wallet_pass_hash=None, target=None, customization_id=None):
+    with db.database.atomic():
+        wallets = generate_and_save_wallets([
+            {'recipient': info['name'], 'virtual_balance': str(to_pip(info['amount'] + 0.01))}
+            for info in recipients.values()
+        ], password_hash=wallet_pass_hash, sender=sender, campaign_id=campaign.id,
             customization_setting_id=customization_id)
-        info['token'] = wallet.link_id
 
-    Recipient.bulk_create([Recipient(
-        email=email, campaign_id=campaign.id,
-        name=info['name'], amount_pip=str(to_pip(info['amount'])),
-        wallet_link_id=info['token'], target_shop=target
-    ) for email, info in recipients.items()], batch_size=100)
-    return campaign, campaign_wallet
+        Recipient.bulk_create([Recipient(
+            email=email, campaign_id=campaign.id,
+            name=info['name'], amount_pip=str(to_pip(info['amount'])),
+            wallet_link_id=wallet.link_id, target_shop=target
+        ) for (email, info), wallet in zip(recipients.items(), wallets)], batch_size=500)
+
+
+def campaign_payment_info(campaign, campaign_wallet, cost):
+    return {
+        'campaign_id': campaign.id,
+        'address': campaign_wallet.address,
+        'deeplink': TxDeeplink.create('send', to=campaign_wallet.address, value=cost).mobile,
+        'total_bip': cost
+    }
+
+
+def enqueue_campaign_job(
+        source, sender=None, target=None, campaign_pass=None, wallet_pass=None, customization_id=None):
+    job = CampaignJob.create(params={
+        'source': source,
+        'sender': sender,
+        'target': target,
+        'customization_id': customization_id,
+        # passwords are never stored in plain text, even temporarily
+        'campaign_pass_hash': pbkdf2_sha256.hash(campaign_pass) if campaign_pass is not None else None,
+        'wallet_pass_hash': pbkdf2_sha256.hash(wallet_pass) if wallet_pass is not None else None,
+    })
+    scheduler.add_job(run_campaign_job, 'date', args=(job.id,))
+    return job
+
+
+def claim_campaign_job(job_id):
+    """ Job is run by the worker which managed to mark it as progress (new or abandoned by crashed worker) """
+    now = datetime.utcnow()
+    return CampaignJob \
+        .update(status='progress', heartbeat=now) \
+        .where(
+            (CampaignJob.id == job_id) & (
+                (CampaignJob.status == 'pending') |
+                ((CampaignJob.status == 'progress') & (CampaignJob.heartbeat < now - CAMPAIGN_JOB_STALE)))) \
+        .execute()
+
+
+def save_campaign_job(job, *fields):
+    job.heartbeat = datetime.utcnow()
+    job.save(only=[CampaignJob.heartbeat, *fields])
+
+
+def fail_campaign_job(job, error, error_status=HTTPStatus.INTERNAL_SERVER_ERROR):
+    job.status = 'failed'
+    job.error = error
+    job.error_status = error_status
+    save_campaign_job(job, CampaignJob.status, CampaignJob.error, CampaignJob.error_status)
+
+
+def run_campaign_job(job_id):
+    if not claim_campaign_job(job_id):
+        return
+    job = CampaignJob.get_by_id(job_id)
+    try:
+        # slow steps (sheet download, big chunks) must not make the job look abandoned
+        with Heartbeat(CampaignJob, job_id):
+            _run_campaign_job(job)
+    except Exception:
+        logging.exception(f'Campaign job {job_id} failed')
+        fail_campaign_job(job, 'Internal API error')
+
+
+def _run_campaign_job(job):
+    """
+    Every step is saved, so job restarted after crash continues where it stopped:
+    parsed sheet is kept in job.recipients, recipients are created in chunks
+    and emails which already have Recipient rows are skipped.
+    """
+    params = job.params
+    if job.recipients is None:
+        result = get_google_sheet_data(params['source'])
+        if isinstance(result, dict):
+            return fail_campaign_job(job, result['error'], HTTPStatus.BAD_REQUEST)
+        if isinstance(result, str):
+            return fail_campaign_job(job, result)
+        recipients, campaign_cost = result
+        if not recipients:
+            return fail_campaign_job(job, 'Recipient list is empty', HTTPStatus.BAD_REQUEST)
+
+        job.recipients = recipients
+        job.params = {**params, 'cost': campaign_cost}
+        job.progress = {'rows_parsed': len(recipients), 'wallets_created': 0, 'recipients_inserted': 0}
+        save_campaign_job(job, CampaignJob.recipients, CampaignJob.params, CampaignJob.progress)
+        params = job.params
+
+    if job.campaign_id is None:
+        with db.database.atomic():
+            # job row is locked: if another worker took the job over, campaign is still created once
+            job.campaign_id = CampaignJob \
+                .select(CampaignJob.campaign_id) \
+                .where(CampaignJob.id == job.id) \
+                .for_update() \
+                .scalar()
+            if job.campaign_id is None:
+                campaign, _ = create_campaign_record(
+                    params['sender'], params['cost'],
+                    campaign_pass_hash=params['campaign_pass_hash'],
+                    customization_id=params['customization_id'])
+                job.campaign_id = campaign.id
+                save_campaign_job(job, CampaignJob.campaign_id)
+    campaign = PushCampaign.get_by_id(job.campaign_id)
+    campaign_wallet = PushWallet.get(link_id=campaign.wallet_link_id)
+
+    created = {email for email, in campaign.recipients.select(Recipient.email).tuples()}
+    to_create = [(email, info) for email, info in job.recipients.items() if email not in created]
+    inserted = len(created)
+    for i in range(0, len(to_create), CAMPAIGN_JOB_CHUNK):
+        chunk = dict(to_create[i:i + CAMPAIGN_JOB_CHUNK])
+        with db.database.atomic():
+            create_campaign_recipients(
+                campaign, chunk, params['sender'],
+                wallet_pass_hash=params['wallet_pass_hash'],
+                target=params['target'],
+                customization_id=params['customization_id'])
+            inserted += len(chunk)
+            job.progress = {**job.progress, 'wallets_created': inserted, 'recipients_inserted': inserted}
+            save_campaign_job(job, CampaignJob.progress)
+
+    job.result = campaign_payment_info(campaign, campaign_wallet, params['cost'])
+    job.status = 'done'
+    save_campaign_job(job, CampaignJob.result, CampaignJob.status)
+
+
+def wait_campaign_job(job_id, timeout=CAMPAIGN_JOB_WAIT):
+    deadline = monotonic() + timeout
+    while True:
+        job = CampaignJob.get_by_id(job_id)
+        if job.status in ['done', 'failed'] or monotonic() >= deadline:
+            return job
+        sleep(0.5)
 
 
 def check_campaign_paid(campaign):
@@ -82,6 +226,7 @@ def get_campaign_stats(campaign, extended=False):
     result = campaign.recipients.select(
         fn.COUNT(Recipient.created_at).alias('emails'),
         fn.COUNT(Recipient.sent_at).alias('sent'),
+        fn.COUNT(Recipient.send_error).alias('failed'),
         fn.COUNT(Recipient.opened_at).alias('open'),
         fn.COUNT(Recipient.linked_at).alias('clicked'))
     summary = result[0] if result else None
@@ -89,6 +234,7 @@ def get_campaign_stats(campaign, extended=False):
         'customization_id': campaign.customization_setting_id,
         'status': campaign.status,
         'sent': 0,
+        'failed': 0,
         'open': 0,
         'clicked': 0
     }
@@ -97,6 +243,7 @@ def get_campaign_stats(campaign, extended=False):
     return {
         'customization_id': campaign.customization_setting_id,
         'sent': summary.sent,
+        'failed': summary.failed,
         'open': summary.open,
         'clicked': summary.clicked,
         'status': campaign.status
@@ -67,10 +67,13 @@ class UserRole(db.Model):
 
 
 class PushWallet(PasswordProtectedModel):
-    link_id = CharField()
+    link_id_length = 6
+
+    link_id = CharField(unique=True)
     sent_from = CharField(null=True)
-    address = CharField()
+    address = CharField(index=True)
     mnemonic = TextField()
+    private_key_enc = TextField(null=True)
 
     virtual_balance = CharField(null=True, default='0')
     seen = BooleanField(default=False)
@@ -82,18 +85,60 @@ class PushWallet(PasswordProtectedModel):
     customization_setting_id = IntegerField(null=True)
 
 
+class SharedCacheEntry(db.Model):
+    """ Value shared between gunicorn workers (see helpers.shared_cache) """
+    key = CharField(unique=True)
+    value = JSONField(null=True)
+    version = IntegerField(default=0)
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+
+class WalletNonce(db.Model):
+    """ Last nonce allocated locally for hot wallet (see providers.minter.allocate_nonce) """
+    address = CharField(unique=True)
+    nonce = IntegerField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+
+class PendingPayout(db.Model):
+    """ Transfer from hot wallet waiting for the next multisend batch (see jobs.payouts) """
+    created_at = DateTimeField(default=datetime.utcnow)
+    source_address = CharField(index=True)
+    to = CharField()
+    coin = CharField()
+    amount_pip = CharField()
+    # multisend commission reserved for the payout
+    fee_pip = CharField(default='0')
+
+    # status:
+    # - pending - ждет отправки
+    # - sending - взята воркером на отправку, tx_hash записан до отправки (зависшие проверяет jobs.payouts)
+    # - sent - отправлена в составе multisend транзакции tx_hash
+    # - confirmed - транзакция tx_hash в блоке
+    # - failed - не удалось отправить за PAYOUT_MAX_ATTEMPTS попыток
+    status = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    tx_hash = CharField(null=True)
+    nonce = IntegerField(null=True)
+    # when batch was taken for sending / signed and sent
+    sent_at = DateTimeField(null=True)
+    confirmed_at = DateTimeField(null=True)
+
+
 class PushCampaign(PasswordProtectedModel):
     company = TextField(default='Unknown Company')
-    wallet_link_id = CharField()
+    wallet_link_id = CharField(index=True)
     cost_pip = CharField()
 
     # status:
     # - open - создана
     # - paid - оплачена
-    # - progress - рассылка идет
+    # - progress - рассылка идет (если heartbeat давно не обновлялся - воркер упал, рассылка продолжается)
     # - completed - рассылка окончена
+    # - failed - ни одно письмо не доставлено (ошибки в Recipient.send_error)
     # - closed - остаток денег возвращен отправителю
     status = CharField()
+    heartbeat = DateTimeField(null=True)
 
     customization_setting_id = IntegerField(null=True)
 
@@ -115,18 +160,20 @@ class OrderHistory(db.Model):
 class WebhookEvent(db.Model):
     timestamp = DateTimeField(default=datetime.utcnow)
     provider = CharField()
-    event_id = CharField()
+    event_id = CharField(index=True)
     event_data = JSONField()
 
 
 class Recipient(db.Model):
     created_at = DateTimeField(default=datetime.utcnow)
     sent_at = DateTimeField(null=True)
+    # email was not delivered after all retries, recipient is skipped when campaign is resumed
+    send_error = TextField(null=True)
     opened_at = DateTimeField(null=True)
     linked_at = DateTimeField(null=True)
 
     campaign_id = ForeignKeyField(PushCampaign, backref='recipients')
-    wallet_link_id = CharField()
+    wallet_link_id = CharField(index=True)
     email = CharField()
     name = TextField()
     amount_pip = CharField()
@@ -140,6 +187,26 @@ class Recipient(db.Model):
         return y_food_url if self.target_shop == 'y-food' else b2ph_url if self.target_shop == 'bip2ph' else ''
 
 
+class CampaignJob(db.Model):
+    """ Background sharing campaign creation (see api.logic.sharing.run_campaign_job) """
+    created_at = DateTimeField(default=datetime.utcnow)
+    heartbeat = DateTimeField(default=datetime.utcnow)
+
+    # status:
+    # - pending - ждет запуска
+    # - progress - выполняется (если heartbeat давно не обновлялся - воркер упал, задача перезапускается)
+    # - done - кампания создана, ответ в result
+    # - failed - ошибка в error, http статус в error_status
+    status = CharField(default='pending')
+    params = JSONField()
+    progress = JSONField(default=dict)
+    recipients = JSONField(null=True)
+    campaign_id = IntegerField(null=True)
+    result = JSONField(null=True)
+    error = TextField(null=True)
+    error_status = IntegerField(null=True)
+
+
 class UserImage(db.Model):
     filename = TextField(null=True)
     url = TextField(default='')
@@ -214,13 +281,32 @@ class Shop(db.Model):
 
     @property
     def api_repr(self):
-        active_products = self.products.where(Product.active & ~Product.deleted)
+        return Shop.bulk_api_repr([self])[self.id]
+
+    @classmethod
+    def bulk_api_repr(cls, shops):
+        """
+        api_repr of many shops at once: active products of all shops are fetched with one query
+        :return: {shop.id: api_repr or None if shop has no active products}
+        """
+        shops = list(shops)
+        if not shops:
+            return {}
+        active_products = {}
+        for product in Product \
+                .select() \
+                .where(Product.shop.in_([shop.id for shop in shops]) & Product.active & ~Product.deleted) \
+                .order_by(Product.id):
+            active_products.setdefault(product.shop_id, []).append(product)
+        return {shop.id: shop._render_api_repr(active_products.get(shop.id)) for shop in shops}
+
+    def _render_api_repr(self, active_products):
         if not active_products:
             return
         shop_repr = {
             'products': [product.api_repr for product in active_products],
         }
-        price_type = 'fixed' if self.brand \
+        price_type = 'fixed' if self.brand_id \
             else 'range' if ('price_list_fiat' not in shop_repr['products'][0]) \
                 or (shop_repr['products'][0]['price_list_fiat'][0] == 0) \
             else 'list'
@@ -249,7 +335,8 @@ class Product(db.Model):
 
     title = CharField()
     description = TextField(null=True)
-    slug = CharField(null=True)
+    # '<provider>-<provider product id>' for integrated providers (see providers.catalog)
+    slug = CharField(null=True, unique=True)
 
     shop = ForeignKeyField(Shop, related_name='products')
 
@@ -292,10 +379,13 @@ class RewardIcon(UserImage):
 
 
 class RewardCampaign(db.Model):
-    link_id = CharField()
+    link_id_length = 6
+
+    link_id = CharField(unique=True)
     name = CharField()
-    address = CharField()
+    address = CharField(index=True)
     mnemonic = TextField()
+    private_key_enc = TextField(null=True)
     count = IntegerField()
     times_completed = IntegerField(default=0)
     coin = CharField()
@@ -304,3 +394,36 @@ class RewardCampaign(db.Model):
     action_params = JSONField()
     icon = ForeignKeyField(RewardIcon, null=True)
     status = CharField(default='open')
+
+    # youtube action target (see api.rewards.resolve_youtube_target)
+    video_id = CharField(null=True)
+    channel_id = CharField(null=True)
+
+
+# Partial indexes for status lookups (only "active" rows are indexed, so they stay small).
+# peewee-db-evolve doesn't handle partial indexes, they are created by create_partial_indexes after evolve
+PARTIAL_INDEXES = [
+    PushCampaign.index(
+        PushCampaign.status, name='pushcampaign_status_active',
+        where=PushCampaign.status.in_(['paid', 'progress'])),
+    PendingPayout.index(
+        PendingPayout.id, name='pendingpayout_id_pending',
+        where=PendingPayout.status == 'pending'),
+    PendingPayout.index(
+        PendingPayout.sent_at, name='pendingpayout_sent_at_in_flight',
+        where=PendingPayout.status.in_(['sending', 'sent'])),
+    RewardCampaign.index(
+        RewardCampaign.action_type, name='rewardcampaign_action_type_open',
+        where=RewardCampaign.status == 'open'),
+    RewardCampaign.index(
+        RewardCampaign.video_id, name='rewardcampaign_video_id_open',
+        where=RewardCampaign.status == 'open'),
+    RewardCampaign.index(
+        RewardCampaign.channel_id, name='rewardcampaign_channel_id_open',
+        where=RewardCampaign.status == 'open'),
+]
+
+
+def create_partial_indexes():
+    for index in PARTIAL_INDEXES:
+        db.database.execute(index)
@@ -1,25 +1,33 @@
 import logging
+from copy import deepcopy
+from datetime import datetime, timedelta
 from http import HTTPStatus
+from threading import Lock
 
-import requests
 from urllib.parse import parse_qs, urlparse
 
+from cachetools import LRUCache
 from cachetools.func import ttl_cache
 from flask import Blueprint
 from flask_restx import Api, Resource, reqparse, fields
 from flask_uploads import extension
 from mintersdk.sdk.wallet import MinterWallet
 from mintersdk.shortcuts import to_pip, to_bip
+from peewee import JOIN
 from werkzeug.datastructures import FileStorage
 
 from api.logic.core import generate_and_save_wallet
-from api.models import RewardCampaign, RewardIcon
+from api.models import db, RewardCampaign, RewardIcon
 from api.upload import images
 from config import YOUTUBE_APIKEY, YYY_PUSH_URL
-from helpers.misc import uuid
+from helpers import shared_cache
+from helpers.link_id import create_with_link_id
 from minter.helpers import TxDeeplink, find_gas_coin
+from minter.keys import get_private_key, encrypt_private_key, evict_private_key
 from minter.tx import estimate_custom_fee, send_coin_tx
-from providers.minter import get_first_transaction
+from providers.http import ProviderHTTP
+from providers.minter import get_first_transaction, send_tx_pipelined, enqueue_payout, reserved_payouts_pip, \
+    PayoutSource
 from providers.nodeapi import NodeAPI
 
 bp_rewards = Blueprint('rewards', __name__, url_prefix='/api/rewards')
@@ -70,27 +78,35 @@ class Campaign(Resource):
             'link': action_link,
             'duration': action_duration
         }
-        campaign_id = uuid()
+        video_id, channel_id = resolve_youtube_target(action_type, action_link)
         wallet = MinterWallet.create()
         action_reward = float(action['reward'])
         one_tx_fee = float(estimate_custom_fee(coin) or 0)
-        campaign_cost = (action_reward + one_tx_fee) * count
+        # reward with the fee to spend it, and multisend commission of the payout (see enqueue_payout)
+        campaign_cost = (action_reward + 2 * one_tx_fee) * count
         deeplink = TxDeeplink.create('send', to=wallet['address'], value=campaign_cost, coin=coin)
 
-        icon_storage = args['icon']
-        filename = images.save(icon_storage, name=f'{campaign_id}.{extension(icon_storage.filename)}')
-        icon = RewardIcon.create(filename=filename, url=images.url(filename))
-        RewardCampaign.create(
-            link_id=campaign_id,
-            address=wallet['address'],
-            mnemonic=wallet['mnemonic'],
-            name=name,
-            count=count,
-            coin=coin,
-            action_type=action['type'],
-            action_reward=to_pip(action_reward),
-            action_params=action,
-            icon=icon)
+        with db.database.atomic():
+            campaign = create_with_link_id(
+                RewardCampaign,
+                address=wallet['address'],
+                mnemonic=wallet['mnemonic'],
+                private_key_enc=encrypt_private_key(wallet['private_key']),
+                name=name,
+                count=count,
+                coin=coin,
+                action_type=action['type'],
+                action_reward=to_pip(action_reward),
+                action_params=action,
+                video_id=video_id,
+                channel_id=channel_id)
+            campaign_id = campaign.link_id
+
+            icon_storage = args['icon']
+            filename = images.save(icon_storage, name=f'{campaign_id}.{extension(icon_storage.filename)}')
+            campaign.icon = RewardIcon.create(filename=filename, url=images.url(filename))
+            campaign.save()
+        invalidate_rewards()
         return {
             'id': campaign_id,
             'address': wallet['address'],
@@ -106,30 +122,47 @@ class CampaignOne(Resource):
         if not campaign:
             return {}, HTTPStatus.NOT_FOUND
 
+        balance_at = datetime.utcnow()
         response = NodeAPI.get_balance(campaign.address)
         balances = response['balance']
-        campaign_balance = to_bip(balances.get(campaign.coin, '0'))
-        if campaign_balance:
-            tx_fee = estimate_custom_fee(campaign.coin)
-            gas_coin = find_gas_coin(balances) if tx_fee is None else campaign.coin
-            if not gas_coin:
-                return {
-                    'error': f'Campaign coin not spendable.'
-                             f'Send any coin to campaign address {campaign.address} to pay fee'
-                }, HTTPStatus.BAD_REQUEST
-            private_key = MinterWallet.create(mnemonic=campaign.mnemonic)['private_key']
+        tx_fee = estimate_custom_fee(campaign.coin)
+        gas_coin = find_gas_coin(balances) if tx_fee is None else campaign.coin
+        if int(balances.get(campaign.coin, '0')) and not gas_coin:
+            return {
+                'error': f'Campaign coin not spendable.'
+                         f'Send any coin to campaign address {campaign.address} to pay fee'
+            }, HTTPStatus.BAD_REQUEST
+
+        # closed before refund: rewards can't be claimed against the balance which is leaving.
+        # row is locked by claims in progress, so their payouts are already queued when it's closed
+        closed = RewardCampaign \
+            .update(status='closed') \
+            .where((RewardCampaign.id == campaign.id) & (RewardCampaign.status == 'open')) \
+            .execute()
+        if not closed:
+            return {}, HTTPStatus.NOT_FOUND
+        invalidate_rewards()
+
+        # rewards already given out are paid from the queue (see jobs.payouts), the rest is refunded
+        reserved_pip = reserved_payouts_pip(campaign.address, campaign.coin, balance_at=balance_at)
+        campaign_balance = to_bip(max(int(balances.get(campaign.coin, '0')) - reserved_pip, 0))
+        tx_fee = 0 if tx_fee is None else tx_fee
+        if campaign_balance > tx_fee:
+            private_key = get_private_key(campaign)
             refund_address = get_first_transaction(campaign.address)
-            nonce = int(response['transaction_count']) + 1
 
-            tx_fee = 0 if tx_fee is None else tx_fee
-            tx = send_coin_tx(
-                private_key, campaign.coin, campaign_balance - tx_fee, refund_address,
-                nonce, gas_coin=campaign.coin)
-            NodeAPI.send_tx(tx, wait=True)
+            pending = send_tx_pipelined(
+                campaign.address,
+                lambda nonce: send_coin_tx(
+                    private_key, campaign.coin, campaign_balance - tx_fee, refund_address,
+                    nonce, gas_coin=campaign.coin),
+                transaction_count=response['transaction_count'])
 
-        campaign.status = 'closed'
-        campaign.save()
-        return {'success': True}
+        if not reserved_pip:
+            evict_private_key(campaign.address)
+        if campaign_balance <= tx_fee:
+            return {'success': True}
+        return {'success': True, 'tx': pending.to_dict()}
 
     def get(self, campaign_id):
         campaign = RewardCampaign.get_or_none(link_id=campaign_id, status='open')
@@ -164,10 +197,22 @@ class CampaignOne(Resource):
 ONE_MINUTE = 60
 ONE_HOUR = 60 * ONE_MINUTE
 
+YOUTUBE_ACTIONS = ['youtube-like', 'youtube-comment', 'youtube-subscribe', 'youtube-watch']
+
+REWARDS_VERSION_KEY = 'rewards'
+# shared per-video snapshots ('rewards:<video id>'), unused ones are dropped by jobs.cleanup
+REWARDS_SNAPSHOT_PREFIX = f'{REWARDS_VERSION_KEY}:'
+REWARDS_SNAPSHOT_TTL = timedelta(days=1)
+# local copies of shared reward snapshots, keyed by (video id, rewards version)
+_rewards_snapshots = LRUCache(maxsize=1024)
+_rewards_lock = Lock()
+
+youtube_http = ProviderHTTP('youtube')
+
 
 @ttl_cache(ttl=24 * ONE_HOUR)
 def get_channel_id(video_id):
-    r = requests.get('https://www.googleapis.com/youtube/v3/videos', params={
+    r = youtube_http.get('https://www.googleapis.com/youtube/v3/videos', params={
         'part': 'snippet',
         'id': video_id,
         'key': YOUTUBE_APIKEY
@@ -180,45 +225,78 @@ def get_channel_id(video_id):
 
 
 def parse_video_id(url):
+    """ youtube.com/watch?v=<id>, youtu.be/<id>, youtube.com/embed/<id>, youtube.com/shorts/<id> """
+    if not url:
+        return None
     parsed = urlparse(url)
     v = parse_qs(parsed.query).get('v')
-    return v[0] if v else None
+    if v:
+        return v[0]
+    path_parts = [part for part in parsed.path.split('/') if part]
+    if parsed.netloc.endswith('youtu.be') and path_parts:
+        return path_parts[0]
+    if len(path_parts) == 2 and path_parts[0] in ['embed', 'shorts']:
+        return path_parts[1]
+    return None
 
 
 def parse_channel_id(url):
-    path_parts = urlparse(url).path.split('/')
-    if 'channel' not in path_parts or 'user' not in path_parts:
+    """ youtube.com/channel/<id> """
+    path_parts = urlparse(url or '').path.split('/')
+    if 'channel' not in path_parts:
         return
-    return path_parts[-1]
+    channel_idx = path_parts.index('channel') + 1
+    return path_parts[channel_idx] if channel_idx < len(path_parts) else None
+
+
+def resolve_youtube_target(action_type, link):
+    """
+    Video and channel which campaign action refers to, stored in indexed columns of campaign.
+    Channel is resolved once here, matcher doesn't call YouTube API for campaigns.
+    """
+    if action_type not in YOUTUBE_ACTIONS:
+        return None, None
+    video_id = parse_video_id(link)
+    if action_type != 'youtube-subscribe':
+        return video_id, None
+    channel_id = parse_channel_id(link) or (get_channel_id(video_id) if video_id else None)
+    return video_id, channel_id
 
 
 def get_campaigns_by_video_id(video_id):
-    campaigns = {}
-    for cmp in RewardCampaign.filter(
-            action_type__in=['youtube-like', 'youtube-comment', 'youtube-subscribe', 'youtube-watch'], status='open'):
-
-        link = cmp.action_params['link']
-        if cmp.action_type == 'youtube-subscribe':
-            if video_id not in link:
-                channel_id = get_channel_id(video_id)
-                if not channel_id or channel_id not in link:
-                    continue
-        if cmp.action_type in ['youtube-watch', 'youtube-like', 'youtube-comment']:
-            if video_id not in link:
-                continue
+    is_related = RewardCampaign.video_id == video_id
+    # channel of the watched video is needed only if someone pays for subscriptions
+    has_subscribe_campaigns = RewardCampaign \
+        .select() \
+        .where(
+            (RewardCampaign.status == 'open') &
+            (RewardCampaign.action_type == 'youtube-subscribe') &
+            RewardCampaign.channel_id.is_null(False)) \
+        .exists()
+    if has_subscribe_campaigns:
+        channel_id = get_channel_id(video_id)
+        if channel_id:
+            is_related |= (RewardCampaign.action_type == 'youtube-subscribe') & \
+                          (RewardCampaign.channel_id == channel_id)
 
-        # check is done
+    campaigns = {}
+    query = RewardCampaign \
+        .select(RewardCampaign, RewardIcon) \
+        .join(RewardIcon, JOIN.LEFT_OUTER) \
+        .where((RewardCampaign.status == 'open') & RewardCampaign.action_type.in_(YOUTUBE_ACTIONS) & is_related)
+    for cmp in query:
         campaigns.setdefault(cmp.action_type, [])
         campaigns[cmp.action_type].append(cmp)
     return campaigns
 
 
-@ttl_cache(ttl=ONE_HOUR)
-def get_available_rewards_video(video_id):
-    if not video_id:
-        return {}
+def invalidate_rewards():
+    """ Called when campaigns are opened/closed: all cached reward lists become outdated """
+    shared_cache.invalidate(REWARDS_VERSION_KEY)
+
+
+def build_rewards_video(video_id):
     campaigns = get_campaigns_by_video_id(video_id)
-    campaigns_ = {}
     rewards = {}
     for action_type, models in campaigns.items():
         rewards.setdefault(action_type, [])
@@ -245,41 +323,86 @@ def get_available_rewards_video(video_id):
                 'status': 'todo',
                 **params
             })
-            campaigns_[cmp.link_id] = cmp
-    return rewards, campaigns_
+    return rewards
 
 
-def generate_push(campaign):
-    response = NodeAPI.get_balance(campaign.address)
-    balances = response['balance']
-    campaign_balance = to_bip(balances.get(campaign.coin, '0'))
-    if not campaign_balance:
-        logging.info(f'Campaign {campaign.link_id} {campaign.name}: balance too low {campaign_balance}')
-        return
+def get_available_rewards_video(video_id):
+    """
+    Reward list of the video (a copy, callers may mutate it).
+    Snapshots are shared between workers and tagged with rewards version,
+    so list built before any campaign was opened/closed is never served.
+    """
+    if not video_id:
+        return {}
+    version = shared_cache.get_version(REWARDS_VERSION_KEY)
+    with _rewards_lock:
+        rewards = _rewards_snapshots.get((video_id, version))
+    if rewards is None:
+        key = f'{REWARDS_SNAPSHOT_PREFIX}{video_id}'
+        entry = shared_cache.get_entry(key)
+        if entry and entry.value and entry.value['version'] == version:
+            rewards = entry.value['rewards']
+        else:
+            rewards = build_rewards_video(video_id)
+            shared_cache.put(key, {'version': version, 'rewards': rewards})
+        with _rewards_lock:
+            _rewards_snapshots[(video_id, version)] = rewards
+    return deepcopy(rewards)
+
+
+def claim_reward(campaign):
+    """ Atomically take one reward of the campaign, closing it when the last one is taken """
+    claimed = RewardCampaign \
+        .update(times_completed=RewardCampaign.times_completed + 1) \
+        .where(
+            (RewardCampaign.id == campaign.id) &
+            (RewardCampaign.status == 'open') &
+            (RewardCampaign.times_completed < RewardCampaign.count)) \
+        .returning(RewardCampaign.times_completed) \
+        .tuples() \
+        .execute()
+    rows = list(claimed)
+    if not rows:
+        return False
+    campaign.times_completed, = rows[0]
+    if campaign.times_completed >= campaign.count:
+        campaign.status = 'closed'
+        RewardCampaign.update(status='closed').where(RewardCampaign.id == campaign.id).execute()
+        invalidate_rewards()
+        logging.info(f'Campaign {campaign.link_id} {campaign.name} finished!')
+    return True
 
+
+def generate_push(campaign):
     tx_fee = estimate_custom_fee(campaign.coin)
     reward = to_bip(campaign.action_reward)
-
-    if campaign_balance < reward + tx_fee:
-        logging.info(f'Campaign {campaign.link_id} {campaign.name}: balance too low {campaign_balance}')
-        return
-
-    push = generate_and_save_wallet()
-    private_key = MinterWallet.create(mnemonic=campaign.mnemonic)['private_key']
-    nonce = int(response['transaction_count']) + 1
-
-    tx = send_coin_tx(
-        private_key, campaign.coin, reward + tx_fee, push.address,
-        nonce, gas_coin=campaign.coin)
-    NodeAPI.send_tx(tx, wait=True)
+    source = PayoutSource(campaign.address, campaign.coin)
+
+    # reward is consumed only together with the push wallet and reserved payout
+    with db.database.atomic() as txn:
+        if not claim_reward(campaign):
+            logging.info(f'Campaign {campaign.link_id} {campaign.name}: no rewards left')
+            return
+
+        push = generate_and_save_wallet()
+        # rewards are sent in multisend batches (see jobs.payouts), balance is checked on enqueue
+        payout = enqueue_payout(source, push.address, reward + tx_fee)
+        if isinstance(payout, str):
+            txn.rollback()
+            logging.info(f'Campaign {campaign.link_id} {campaign.name}: {payout}')
+            return
     logging.info(f'Campaign {campaign.link_id} {campaign.name} rewarded {reward} {campaign.coin}, fee {tx_fee}')
+    return {'push_link': YYY_PUSH_URL + push.link_id, 'payout_id': payout.id}
 
-    campaign.times_completed += 1
-    if campaign.times_completed == campaign.count:
-        campaign.status = 'close'
-        logging.info(f'Campaign {campaign.link_id} {campaign.name} finished!')
-    campaign.save()
-    return YYY_PUSH_URL + push.link_id
+
+def complete_task(task):
+    campaign = RewardCampaign.get_or_none(link_id=task['id'], status='open')
+    reward = generate_push(campaign) if campaign else None
+    if not reward:
+        task['status'] = 'errored'
+        return
+    task['status'] = 'done'
+    task.update(reward)
 
 
 @ns_action.route('/')
@@ -298,30 +421,19 @@ class Action(Resource):
         logging.info(f'##### {args}')
 
         available_rewards = {}
-        campaigns = {}
         if args['video']:
             video_id = parse_video_id(args['video'])
-            available_rewards, campaigns = get_available_rewards_video(video_id)
+            available_rewards = get_available_rewards_video(video_id)
 
         if args['type'] == 'youtube-watch' and 'youtube-watch' in available_rewards:
             duration = args['duration'] or 0
             for task in available_rewards['youtube-watch']:
-                if duration >= task['duration']:
-                    push_link = generate_push(campaigns[task['id']])
-                    if not push_link:
-                        task['status'] = 'errored'
-                        continue
-                    task['status'] = 'done'
-                    task['push_link'] = push_link
+                if duration >= task.get('duration', 0):
+                    complete_task(task)
 
         if args['type'] in ['youtube-comment', 'youtube-like', 'youtube-subscribe']:
             for task in available_rewards.get(args['type'], []):
-                push_link = generate_push(campaigns[task['id']])
-                if not push_link:
-                    task['status'] = 'errored'
-                    continue
-                task['status'] = 'done'
-                task['push_link'] = push_link
+                complete_task(task)
 
         all_rewards = []
         for rewards in available_rewards.values():
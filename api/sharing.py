@@ -3,9 +3,10 @@ from decimal import Decimal
 from http import HTTPStatus
 from flask import Blueprint, request, jsonify
 
-from api.logic.sharing import get_google_sheet_data, create_campaign, check_campaign_paid, get_campaign_stats
-from api.models import PushCampaign, PushWallet
-from minter.helpers import TxDeeplink
+from api.logic.sharing import get_google_sheet_data, check_campaign_paid, get_campaign_stats, \
+    enqueue_campaign_job, wait_campaign_job
+from api.models import PushCampaign, PushWallet, CampaignJob
+from minter.keys import evict_private_key
 from providers.minter import get_balance, send_coins, get_first_transaction
 
 bp_sharing = Blueprint('sharing', __name__, url_prefix='/api/sharing')
@@ -53,29 +54,38 @@ def campaign_create():
     if not spreadsheet_url:
         return jsonify({'error': 'Sheet url not specified'}), HTTPStatus.BAD_REQUEST
 
-    result = get_google_sheet_data(spreadsheet_url)
-    if isinstance(result, dict):
-        return jsonify(result), HTTPStatus.BAD_REQUEST
-    if isinstance(result, str):
-        return jsonify({'error': result}), HTTPStatus.INTERNAL_SERVER_ERROR
-
-    recipients, campaign_cost = result
-    if not recipients:
-        return jsonify({'error': 'Recipient list is empty'}), HTTPStatus.BAD_REQUEST
-
-    campaign, campaign_wallet = create_campaign(
-        recipients, sender, campaign_cost,
+    job = enqueue_campaign_job(
+        spreadsheet_url,
+        sender=sender,
+        target=target,
         campaign_pass=cmp_pass,
         wallet_pass=wall_pass,
-        target=target,
         customization_id=customization_setting_id)
+    job = wait_campaign_job(job.id)
+    return campaign_job_response(job)
 
+
+@bp_sharing.route('/job/<int:job_id>')
+def campaign_job(job_id):
+    """
+    swagger: swagger/sharing/campaign-job.yml
+    """
+    job = CampaignJob.get_or_none(id=job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), HTTPStatus.NOT_FOUND
+    return campaign_job_response(job)
+
+
+def campaign_job_response(job):
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), job.error_status
+    if job.status == 'done':
+        return jsonify({**job.result, 'job_id': job.id})
     return jsonify({
-        'campaign_id': campaign.id,
-        'address': campaign_wallet.address,
-        'deeplink': TxDeeplink.create('send', to=campaign_wallet.address, value=campaign_cost).mobile,
-        'total_bip': campaign_cost
-    })
+        'job_id': job.id,
+        'status': job.status,
+        'progress': job.progress
+    }), HTTPStatus.ACCEPTED
 
 
 @bp_sharing.route('/<int:campaign_id>/check-payment')
@@ -137,8 +147,9 @@ def campaign_close(campaign_id):
             # тут скорее всего есть баг - нужно еще виртуальные балансы обнулять
             # иначе с рассылки придет челик, проверит баланс, увидит виртуальный
             # и продукт встретит его пятисоткой потому что на балансе кампании 0
-            if result is not True:
+            if isinstance(result, str):
                 return jsonify({'error': result}), HTTPStatus.INTERNAL_SERVER_ERROR
+        evict_private_key(wallet.address)
 
     return jsonify({
         'amount_left': float(amount_left) if amount_left >= 0 else 0,
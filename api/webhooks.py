@@ -1,14 +1,13 @@
-import logging
-from datetime import datetime
-from pprint import pformat
+from flask import Blueprint, request, Response
 
-from flask import Blueprint, request, send_file
-
-from api.models import Recipient
+from jobs.tracking import track_open
 from providers.gift import gift_webhook_controller
 
 bp_webhooks = Blueprint('webhook', __name__, url_prefix='/webhooks')
 
+with open('content/pixel.gif', 'rb') as f:
+    PIXEL_GIF = f.read()
+
 
 @bp_webhooks.route('/gift/<order_id>', methods=['POST'])
 def gift_order_result(order_id):
@@ -18,10 +17,5 @@ def gift_order_result(order_id):
 
 @bp_webhooks.route('/pixel/<mail_stat_id>', methods=['GET'])
 def pixel(mail_stat_id):
-    logging.info(f"PIXEL WORKS {mail_stat_id}")
-    logging.info(pformat(request.__dict__))
-    recipient = Recipient.get(id=mail_stat_id)
-    if recipient.opened_at is None:
-        recipient.opened_at = datetime.utcnow()
-        recipient.save()
-    return send_file(open('content/pixel.gif', 'rb'), mimetype='image/gif')
+    track_open(mail_stat_id)
+    return Response(PIXEL_GIF, mimetype='image/gif', headers={'Cache-Control': 'no-store'})
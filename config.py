@@ -22,16 +22,23 @@ GRATZ_API_KEY = os.environ.get('GRATZ_API_KEY')
 UNU_API_KEY = os.environ.get('UNU_API_KEY')
 
 BIP_WALLET = os.environ.get('BIP_WALLET')
+# wallet private keys are stored encrypted with this secret (see minter.keys), keys aren't stored without it
+KEY_ENCRYPTION_SECRET = os.environ.get('KEY_ENCRYPTION_SECRET')
 
 SMTP_HOST = 'smtp-mail.outlook.com'
 SMTP_PORT = 587
 EMAIL_SENDER = "noreply@push.money"
 EMAIL_PASS = os.environ.get('EMAIL_PASS')
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '4'))
+SMTP_RATE_LIMIT = float(os.environ.get('SMTP_RATE_LIMIT', '10'))  # emails per second
+SMTP_MAX_RETRIES = int(os.environ.get('SMTP_MAX_RETRIES', '3'))
 
 GRATZ_OWNER_EMAIL = 'amperluxe@gmail.com'
 DEV_EMAIL = 'ivan.d.kotelnikov@gmail.com'
 
 ADMIN_PASS = os.environ.get('ADMIN_PASS')
+# /api/metrics for monitoring ('Authorization: Bearer <token>'), admins may open it without token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 DB_NAME = os.environ.get('{}DB_NAME'.format('DEV_' if DEV else ''))
 DB_USER = os.environ.get('{}DB_USER'.format('DEV_' if DEV else ''))
@@ -45,13 +52,24 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
 NODE_API = os.getenv('NODE_API', 'funfasy')
 FUNFASY_PROJECT_ID = os.getenv('FUNFASY_PROJECT_ID', '')
 FUNFASY_PROJECT_SECRET = os.getenv('FUNFASY_PROJECT_SECRET', '')
+NODE_API_POOL_SIZE = int(os.getenv('NODE_API_POOL_SIZE', '10'))
+NODE_API_CONNECT_TIMEOUT = float(os.getenv('NODE_API_CONNECT_TIMEOUT', '3'))
+NODE_API_READ_TIMEOUT = float(os.getenv('NODE_API_READ_TIMEOUT', '10'))
+
+# connection pool of each gunicorn worker (shared by request and scheduler threads)
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '20'))
+DB_STALE_TIMEOUT = int(os.getenv('DB_STALE_TIMEOUT', '300'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '10'))
 
 class FlaskConfig:
     LOCAL = LOCAL
     DATABASE = {
         'name': DB_NAME,
-        'engine': 'peewee.PostgresqlDatabase',
-        'user': DB_USER
+        'engine': 'playhouse.pool.PooledPostgresqlDatabase',
+        'user': DB_USER,
+        'max_connections': DB_MAX_CONNECTIONS,
+        'stale_timeout': DB_STALE_TIMEOUT,
+        'timeout': DB_POOL_TIMEOUT
     }
     FLASK_ADMIN_SWATCH = 'cyborg'
 
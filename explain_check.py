@@ -0,0 +1,106 @@
+"""
+Query plan audit for hot API lookups.
+
+Seeds a large dataset inside a transaction, runs EXPLAIN for every query in HOT_QUERIES
+and exits with non-zero code if any of them uses a sequential scan.
+Transaction is rolled back, so the script is safe to run against dev database.
+
+    python explain_check.py [rows]
+"""
+import sys
+from datetime import datetime
+from random import choice
+
+from api.app_init import app_init
+from api.models import db, PushWallet, Recipient, PushCampaign, WebhookEvent, RewardCampaign, PendingPayout
+from providers.minter import reserved_payouts_query
+
+SEED_ROWS = 100000
+SEED_BATCH = 5000
+
+REWARD_ACTIONS = ['youtube-like', 'youtube-comment', 'youtube-subscribe', 'youtube-watch']
+
+HOT_QUERIES = {
+    'push wallet by link id': lambda: PushWallet.select().where(PushWallet.link_id == 'w-42'),
+    'push wallet by address': lambda: PushWallet.select().where(PushWallet.address == 'Mxw-42'),
+    'recipient by wallet link id': lambda: Recipient.select().where(Recipient.wallet_link_id == 'w-42'),
+    'recipients of campaign': lambda: Recipient.select().where(Recipient.campaign_id == SEEDED['campaign_id']),
+    'campaign by wallet link id': lambda: PushCampaign.select().where(PushCampaign.wallet_link_id == 'c-42'),
+    'paid campaigns': lambda: PushCampaign.select().where(PushCampaign.status == 'paid'),
+    'webhook event by id': lambda: WebhookEvent.select().where(WebhookEvent.event_id == 'e-42'),
+    'reward campaign by link id': lambda: RewardCampaign.select().where(
+        (RewardCampaign.link_id == 'r-42') & (RewardCampaign.status == 'open')),
+    'reward campaign by address': lambda: RewardCampaign.select().where(RewardCampaign.address == 'Mxr-42'),
+    'open reward campaigns by action': lambda: RewardCampaign.select().where(
+        RewardCampaign.action_type.in_(REWARD_ACTIONS) & (RewardCampaign.status == 'open')),
+    'open reward campaigns by video': lambda: RewardCampaign.select().where(
+        (RewardCampaign.status == 'open') & RewardCampaign.action_type.in_(REWARD_ACTIONS) & (
+            (RewardCampaign.video_id == 'v-42') |
+            ((RewardCampaign.action_type == 'youtube-subscribe') & (RewardCampaign.channel_id == 'ch-42')))),
+    'pending payouts': lambda: PendingPayout.select().where(PendingPayout.status == 'pending')
+        .order_by(PendingPayout.id).limit(1000),
+    'reserved payouts of wallet': lambda: reserved_payouts_query('Mxw-42', 'BIP'),
+    'stale payouts': lambda: PendingPayout.select().where(
+        PendingPayout.status.in_(['sending', 'sent']) & (PendingPayout.sent_at < datetime(2020, 1, 1)))
+        .order_by(PendingPayout.id).limit(1000),
+}
+SEEDED = {}
+
+
+def seed(model, count, make_row):
+    for start in range(0, count, SEED_BATCH):
+        model.insert_many([make_row(i) for i in range(start, min(start + SEED_BATCH, count))]).execute()
+
+
+def seed_dataset(rows):
+    campaigns = rows // 10
+    seed(PushCampaign, campaigns, lambda i: {
+        'wallet_link_id': f'c-{i}', 'cost_pip': '0',
+        'status': 'paid' if i % 1000 == 0 else 'completed'})
+    campaign_ids = [c.id for c in PushCampaign.select(PushCampaign.id).where(PushCampaign.wallet_link_id ** 'c-%')]
+    SEEDED['campaign_id'] = campaign_ids[0]
+
+    seed(PushWallet, rows, lambda i: {'link_id': f'w-{i}', 'address': f'Mxw-{i}', 'mnemonic': ''})
+    seed(Recipient, rows, lambda i: {
+        'campaign_id': campaign_ids[i % campaigns], 'wallet_link_id': f'w-{i}',
+        'email': f'{i}@example.com', 'name': '', 'amount_pip': '0'})
+    seed(WebhookEvent, rows, lambda i: {'provider': 'gift', 'event_id': f'e-{i}', 'event_data': {}})
+    seed(RewardCampaign, rows, lambda i: {
+        'link_id': f'r-{i}', 'name': '', 'address': f'Mxr-{i}', 'mnemonic': '', 'count': 1,
+        'coin': 'BIP', 'action_type': choice(REWARD_ACTIONS), 'action_reward': '0', 'action_params': {},
+        'video_id': f'v-{i}', 'channel_id': f'ch-{i % 1000}',
+        'status': 'open' if i % 500 == 0 else 'closed'})
+    seed(PendingPayout, rows, lambda i: {
+        'source_address': f'Mxw-{i}', 'to': f'Mxw-{i}', 'coin': 'BIP', 'amount_pip': '0',
+        'status': 'pending' if i % 1000 == 0 else 'confirmed'})
+
+    for model in [PushCampaign, PushWallet, Recipient, WebhookEvent, RewardCampaign, PendingPayout]:
+        db.database.execute_sql(f'ANALYZE "{model._meta.table_name}"')
+
+
+def explain(query):
+    sql, params = query.sql()
+    cursor = db.database.execute_sql(f'EXPLAIN {sql}', params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def check_query_plans(rows=SEED_ROWS):
+    failed = []
+    with db.database.atomic() as txn:
+        seed_dataset(rows)
+        for name, make_query in HOT_QUERIES.items():
+            plan = explain(make_query())
+            ok = 'Seq Scan' not in plan
+            print(f'[{"OK" if ok else "SEQ SCAN"}] {name}')
+            if not ok:
+                print(plan)
+                failed.append(name)
+        txn.rollback()
+    return failed
+
+
+if __name__ == '__main__':
+    app = app_init()
+    with app.app_context(), db.database.connection_context():
+        failed = check_query_plans(int(sys.argv[1]) if len(sys.argv) > 1 else SEED_ROWS)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,48 @@
+"""
+Liveness mark of a long background job stored in DB row (`heartbeat` field).
+Row with old heartbeat is considered abandoned by crashed worker and may be taken by another one.
+"""
+import logging
+from datetime import datetime
+from threading import Event, Thread
+
+from api.models import db
+
+
+class Heartbeat:
+    """
+    Touch row heartbeat every `interval` seconds from a background thread while the job runs:
+
+        with Heartbeat(CampaignJob, job.id):
+            run(job)
+    """
+
+    def __init__(self, model, row_id, interval=30):
+        self.model = model
+        self.row_id = row_id
+        self.interval = interval
+        self._stop = Event()
+        self._thread = None
+
+    def beat(self):
+        with db.database.connection_context():
+            self.model \
+                .update(heartbeat=datetime.utcnow()) \
+                .where(self.model.id == self.row_id) \
+                .execute()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                logging.exception(f'{self.model.__name__} {self.row_id}: heartbeat failed')
+
+    def __enter__(self):
+        self._thread = Thread(target=self._run, name=f'heartbeat-{self.row_id}', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,63 @@
+"""
+Short random link ids (push links, reward campaign links).
+
+Uniqueness is guaranteed by unique index on `link_id` column: row is inserted with a fresh id
+and insert is retried on conflict, so allocation costs one query regardless of table size
+and is safe between workers. Id length is set per model by `link_id_length` attribute.
+"""
+from peewee import IntegrityError
+from shortuuid import uuid as _uuid
+
+LINK_ID_MAX_ATTEMPTS = 10
+
+
+class LinkIdExhausted(Exception):
+    pass
+
+
+def generate_link_id(model):
+    return _uuid()[:model.link_id_length]
+
+
+def is_link_id_conflict(exc):
+    # postgres: duplicate key value violates unique constraint "pushwallet_link_id"
+    return 'link_id' in str(exc)
+
+
+def create_with_link_id(model, **fields):
+    for _ in range(LINK_ID_MAX_ATTEMPTS):
+        try:
+            with model._meta.database.atomic():
+                return model.create(link_id=generate_link_id(model), **fields)
+        except IntegrityError as exc:
+            if not is_link_id_conflict(exc):
+                raise
+    raise LinkIdExhausted(f'Could not allocate {model.__name__} link id, consider increasing link_id_length')
+
+
+def bulk_create_with_link_ids(model, instances, batch_size=500):
+    """
+    Insert instances with fresh link ids. Conflicting rows are skipped by ON CONFLICT DO NOTHING
+    and inserted again with new ids.
+    """
+    pending = list(instances)
+    for _ in range(LINK_ID_MAX_ATTEMPTS):
+        link_ids = set()
+        while len(link_ids) < len(pending):
+            link_ids.add(generate_link_id(model))
+        for obj, link_id in zip(pending, link_ids):
+            obj.link_id = link_id
+
+        inserted = set()
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            query = model \
+                .insert_many([obj.__data__ for obj in batch]) \
+                .on_conflict_ignore() \
+                .returning(model.link_id) \
+                .tuples()
+            inserted |= {link_id for link_id, in query.execute()}
+        pending = [obj for obj in pending if obj.link_id not in inserted]
+        if not pending:
+            return instances
+    raise LinkIdExhausted(f'Could not allocate {model.__name__} link ids, consider increasing link_id_length')
@@ -5,8 +5,6 @@ from time import sleep
 from typing import Union, Iterable, Callable
 import math
 
-from shortuuid import uuid as _uuid
-
 from config import LOG_LEVEL
 
 
@@ -61,15 +59,3 @@ def truncate(number, digits) -> float:
     stepper = 10.0 ** digits
     return math.trunc(stepper * number) / stepper
 
-
-def uuid(unique_for_model=None, model_param=None, length=6):
-    if not unique_for_model:
-        return _uuid()[:length]
-    if unique_for_model and not model_param:
-        raise RuntimeError('Model param not specified')
-
-    while True:
-        link_id = _uuid()[:length]
-        if unique_for_model.get_or_none(**{model_param: link_id}):
-            continue
-        return link_id
@@ -0,0 +1,101 @@
+"""
+Postgres LISTEN/NOTIFY: wakes up threads waiting for an event which may be produced by another worker.
+
+Every process runs one listener thread with its own (non-pooled) connection,
+waiters subscribe to (channel, payload) and are released when matching notification arrives.
+"""
+import logging
+import os
+import select
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from time import sleep
+
+import psycopg2
+
+from api.models import db
+
+RECONNECT_DELAY = 3
+
+
+def notify(channel, payload):
+    """ Delivered to listeners when current transaction commits (immediately outside of transaction) """
+    db.database.execute_sql('SELECT pg_notify(%s, %s)', (channel, payload))
+
+
+class PgListener:
+    def __init__(self, channel, poll_timeout=5):
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self._lock = Lock()
+        self._waiters = {}
+        self._thread = None
+        self._thread_pid = None
+        self._listening = Event()
+
+    @contextmanager
+    def subscribe(self, payload):
+        """
+        Subscribe before checking state in DB, then wait on yielded event:
+        notification sent between the check and the wait is not lost.
+        """
+        self._ensure_listener()
+        event = Event()
+        with self._lock:
+            self._waiters.setdefault(payload, []).append(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(payload, [])
+                if event in waiters:
+                    waiters.remove(event)
+                if not waiters:
+                    self._waiters.pop(payload, None)
+
+    def _dispatch(self, payload):
+        with self._lock:
+            waiters = self._waiters.pop(payload, [])
+        for event in waiters:
+            event.set()
+
+    def _ensure_listener(self):
+        # gunicorn forks workers: every process should run its own listener
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._listening.clear()
+            self._thread = Thread(target=self._run, name=f'pg-listen-{self.channel}', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+        # notifications are not queued for us before LISTEN is executed
+        self._listening.wait(self.poll_timeout)
+
+    def _connect(self):
+        conn = psycopg2.connect(database=db.database.database, **db.database.connect_params)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _run(self):
+        while True:
+            try:
+                conn = self._connect()
+                self._listening.set()
+                self._listen(conn)
+            except Exception:
+                logging.exception(f'PgListener {self.channel} failed, reconnecting')
+                sleep(RECONNECT_DELAY)
+
+    def _listen(self, conn):
+        try:
+            while True:
+                readable, _, _ = select.select([conn], [], [], self.poll_timeout)
+                if not readable:
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
@@ -0,0 +1,90 @@
+"""
+Cache shared between gunicorn workers, stored in Postgres (SharedCacheEntry).
+
+Every put/invalidate increments entry version, so workers may keep local copies (SharedValue)
+and re-read the value only when the version in DB differs from the local one.
+"""
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+
+from peewee import EXCLUDED
+
+from api.models import SharedCacheEntry
+
+
+def get_entry(key):
+    return SharedCacheEntry.get_or_none(key=key)
+
+
+def get_version(key):
+    version = SharedCacheEntry.select(SharedCacheEntry.version).where(SharedCacheEntry.key == key).scalar()
+    return version or 0
+
+
+def put(key, value):
+    SharedCacheEntry \
+        .insert(key=key, value=value, version=1, updated_at=datetime.utcnow()) \
+        .on_conflict(
+            conflict_target=[SharedCacheEntry.key],
+            update={
+                SharedCacheEntry.value: EXCLUDED.value,
+                SharedCacheEntry.version: SharedCacheEntry.version + 1,
+                SharedCacheEntry.updated_at: EXCLUDED.updated_at}) \
+        .execute()
+
+
+def invalidate(key):
+    put(key, None)
+
+
+def pop(key):
+    """ Delete entry and return its value, only one of concurrent callers gets it """
+    deleted = SharedCacheEntry \
+        .delete() \
+        .where(SharedCacheEntry.key == key) \
+        .returning(SharedCacheEntry.value) \
+        .execute()
+    for entry in deleted:
+        return entry.value
+    return None
+
+
+def delete_stale(prefix, updated_before):
+    """ Drop short-lived entries (keys starting with `prefix`) not updated since `updated_before` """
+    return SharedCacheEntry \
+        .delete() \
+        .where(SharedCacheEntry.key.startswith(prefix) & (SharedCacheEntry.updated_at < updated_before)) \
+        .execute()
+
+
+class SharedValue:
+    """
+    Local copy of a shared entry.
+       - version in DB is checked at most once per `check_interval` seconds
+       - value is built with `builder` and shared with other workers if entry is missing or invalidated
+    """
+
+    def __init__(self, key, builder, check_interval=5):
+        self.key = key
+        self.builder = builder
+        self.check_interval = check_interval
+        self._value = None
+        self._version = None
+        self._checked_at = None
+        self._lock = Lock()
+
+    def get(self):
+        with self._lock:
+            if self._checked_at is not None and monotonic() - self._checked_at < self.check_interval:
+                return self._value
+
+            version = get_version(self.key)
+            if version != self._version or self._value is None:
+                entry = get_entry(self.key)
+                if entry is None or entry.value is None:
+                    put(self.key, self.builder())
+                    entry = get_entry(self.key)
+                self._value, self._version = entry.value, entry.version
+            self._checked_at = monotonic()
+            return self._value
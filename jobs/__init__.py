@@ -1 +1,7 @@
-from jobs.mailer import *
\ No newline at end of file
+from jobs.mailer import *
+from jobs.payouts import *
+from jobs.rates import *
+from jobs.campaigns import *
+from jobs.cleanup import *
+from jobs.tracking import *
+from jobs.catalog import *
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from api.models import CampaignJob
+from jobs.scheduler import scheduler
+
+
+@scheduler.scheduled_job('interval', minutes=1)
+def job_resume_campaign_jobs():
+    """ Restart campaign creation jobs lost with crashed/restarted worker """
+    # api.logic imports providers, which import jobs
+    from api.logic.sharing import run_campaign_job, CAMPAIGN_JOB_STALE
+
+    stale_since = datetime.utcnow() - CAMPAIGN_JOB_STALE
+    abandoned = CampaignJob \
+        .select(CampaignJob.id) \
+        .where(
+            ((CampaignJob.status == 'pending') & (CampaignJob.created_at < stale_since)) |
+            ((CampaignJob.status == 'progress') & (CampaignJob.heartbeat < stale_since)))
+    for job in abandoned:
+        run_campaign_job(job.id)
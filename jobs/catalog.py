@@ -0,0 +1,13 @@
+from datetime import timedelta
+
+from jobs.scheduler import scheduler
+
+CATALOG_SYNC_INTERVAL = timedelta(minutes=30)
+
+
+@scheduler.scheduled_job('interval', minutes=5, disable_dev=True)
+def job_sync_catalog():
+    """ Pull provider catalogs into Shop/Product tables once per CATALOG_SYNC_INTERVAL (in any worker) """
+    # providers.catalog imports providers, which import jobs
+    from providers.catalog import sync_catalog
+    sync_catalog(min_interval=CATALOG_SYNC_INTERVAL)
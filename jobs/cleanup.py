@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+from peewee import fn
+from social_flask_peewee.models import FlaskStorage
+
+from api.logic.quotes import delete_expired_quotes
+from api.models import db, User, Role, UserRole, Merchant
+from helpers import shared_cache
+from jobs.scheduler import scheduler
+
+ANONYMOUS_USER_TTL = timedelta(days=30)
+CLEANUP_BATCH_SIZE = 5000
+CLEANUP_LOCK_ID = 0x636c6e  # pg advisory lock key, job runs in every worker
+
+
+def delete_orphan_anonymous_users(batch_size=CLEANUP_BATCH_SIZE):
+    """
+    Delete one batch of anonymous users not seen for ANONYMOUS_USER_TTL,
+    which have no other roles, social auth accounts or merchants.
+    :return: number of deleted users, None if batch is processed by another worker
+    """
+    anonymous_role = Role.get_or_none(name='anonymous')
+    if not anonymous_role:
+        return 0
+    SocialAuth = FlaskStorage.user
+    OtherRole = UserRole.alias()
+    seen_before = datetime.utcnow() - ANONYMOUS_USER_TTL
+
+    with db.database.atomic():
+        is_locked = db.database \
+            .execute_sql('SELECT pg_try_advisory_xact_lock(%s)', (CLEANUP_LOCK_ID,)) \
+            .fetchone()[0]
+        if not is_locked:
+            return None
+
+        orphans = User \
+            .select(User.id) \
+            .join(UserRole, on=(UserRole.user == User.id)) \
+            .where(
+                (UserRole.role == anonymous_role) &
+                User.email.is_null() &
+                (User.current_login_at.is_null() | (User.current_login_at < seen_before)) &
+                ~fn.EXISTS(OtherRole.select().where(
+                    (OtherRole.user == User.id) & (OtherRole.role != anonymous_role))) &
+                ~fn.EXISTS(SocialAuth.select().where(SocialAuth.user == User.id)) &
+                ~fn.EXISTS(Merchant.select().where(Merchant.user == User.id))) \
+            .limit(batch_size)
+        user_ids = [user.id for user in orphans]
+        if not user_ids:
+            return 0
+        UserRole.delete().where(UserRole.user.in_(user_ids)).execute()
+        User.delete().where(User.id.in_(user_ids)).execute()
+    return len(user_ids)
+
+
+@scheduler.scheduled_job('interval', minutes=10, disable_dev=True)
+def job_cleanup_anonymous_users():
+    # small batches keep transactions (and locks on user table) short
+    while delete_orphan_anonymous_users() == CLEANUP_BATCH_SIZE:
+        pass
+
+
+@scheduler.scheduled_job('interval', minutes=10, disable_dev=True)
+def job_cleanup_quotes():
+    delete_expired_quotes()
+
+
+@scheduler.scheduled_job('interval', hours=1, disable_dev=True)
+def job_cleanup_rewards_snapshots():
+    # local import: api.rewards imports providers, which import jobs
+    from api.rewards import REWARDS_SNAPSHOT_PREFIX, REWARDS_SNAPSHOT_TTL
+    # snapshots are rebuilt on demand, so entries of videos not requested for a while are just dropped
+    shared_cache.delete_stale(REWARDS_SNAPSHOT_PREFIX, datetime.utcnow() - REWARDS_SNAPSHOT_TTL)
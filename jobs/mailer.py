@@ -1,12 +1,18 @@
 import logging
 import smtplib
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from threading import Lock, local
+from time import monotonic, sleep
 
-from api.models import PushCampaign, PushWallet, OrderHistory, CustomizationSetting, UserImage
+from api.models import PushCampaign, PushWallet, OrderHistory, CustomizationSetting, UserImage, Recipient
 from api.upload import images
-from config import EMAIL_PASS, SMTP_HOST, EMAIL_SENDER, GRATZ_OWNER_EMAIL, DEV_EMAIL, SMTP_PORT
+from config import EMAIL_PASS, SMTP_HOST, EMAIL_SENDER, GRATZ_OWNER_EMAIL, DEV_EMAIL, SMTP_PORT, \
+    SMTP_POOL_SIZE, SMTP_RATE_LIMIT, SMTP_MAX_RETRIES
+from helpers.heartbeat import Heartbeat
+from helpers.metrics import metrics
 from jobs.scheduler import scheduler
 from mintersdk.shortcuts import to_bip
 
@@ -28,70 +34,251 @@ API response: {api_response}
 """
 
 
-def build_custom_email(person, campaign):
-    name, company, amount, recipient_id = \
-        person.name, campaign.company, str(to_bip(person.amount_pip)), str(person.id)
-    customization = CustomizationSetting.get_or_none(id=campaign.customization_setting_id)
-
-    msg_variables_tmpl = SHARING_TMPL_DEFAULT_VARS.copy()
-    if customization:
-        img = UserImage.get_or_none(id=customization.email_image_id)
-        with scheduler.app.app_context():
-            custom_img_url = images.url(img.filename) if img else None
-        changes = {
-            'email_image_url': custom_img_url,
-            'email_head_text': customization.email_head_text,
-            'email_body_text': customization.email_body_text,
-            'email_button_text': customization.email_button_text,
-            'email_subject_text': customization.email_subject_text,
+SENT_AT_FLUSH_SIZE = 100
+RETRY_BACKOFF = 5
+# progress campaign with older heartbeat is considered abandoned by crashed worker
+CAMPAIGN_STALE = timedelta(minutes=2)
+
+# per-campaign delivery stats of this process, exposed as a gauge
+campaign_stats = {}
+
+
+class TokenBucket:
+    """ Rate limit shared by all connections of SMTP pool """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def smtp_connect():
+    server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    server.starttls()
+    server.login(EMAIL_SENDER, EMAIL_PASS)
+    return server
+
+
+def is_transient(exc):
+    """ 4xx replies, disconnects and network errors are worth retrying """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPException):
+        return isinstance(exc, smtplib.SMTPServerDisconnected)
+    return isinstance(exc, OSError)
+
+
+class SMTPPool:
+    """ Thread pool where every thread keeps its own SMTP connection """
+
+    def __init__(self, size=SMTP_POOL_SIZE, rate=SMTP_RATE_LIMIT):
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='smtp')
+        self.throttle = TokenBucket(rate)
+        self._local = local()
+        self._lock = Lock()
+        self._connections = []
+
+    def _connection(self):
+        server = getattr(self._local, 'server', None)
+        if server is None:
+            server = self._local.server = smtp_connect()
+            with self._lock:
+                self._connections.append(server)
+        return server
+
+    def _drop_connection(self):
+        server = getattr(self._local, 'server', None)
+        if server is None:
+            return
+        self._local.server = None
+        with self._lock:
+            self._connections.remove(server)
+        try:
+            server.close()
+        except OSError:
+            pass
+
+    def _send(self, build_msg, *args):
+        msg = build_msg(*args)
+        self.throttle.acquire()
+        try:
+            with metrics.timer('mailer.send'):
+                self._connection().send_message(msg)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # server rejected the message, connection itself is fine
+            raise
+        except OSError:
+            self._drop_connection()
+            raise
+
+    def submit(self, build_msg, *args):
+        return self.executor.submit(self._send, build_msg, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for server in self._connections:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        self._connections = []
+
+
+class CampaignEmail:
+    """ Email template of a campaign, customization is resolved once for all recipients """
+
+    def __init__(self, campaign):
+        self.company = campaign.company
+        customization = CustomizationSetting.get_or_none(id=campaign.customization_setting_id)
+
+        msg_variables_tmpl = SHARING_TMPL_DEFAULT_VARS.copy()
+        if customization:
+            img = UserImage.get_or_none(id=customization.email_image_id)
+            with scheduler.app.app_context():
+                custom_img_url = images.url(img.filename) if img else None
+            changes = {
+                'email_image_url': custom_img_url,
+                'email_head_text': customization.email_head_text,
+                'email_body_text': customization.email_body_text,
+                'email_button_text': customization.email_button_text,
+                'email_subject_text': customization.email_subject_text,
+            }
+            msg_variables_tmpl.update(**{k: v for k, v in changes.items() if v is not None})
+        self.msg_variables_tmpl = msg_variables_tmpl
+        self.html_tmpl = SHARING_MSG_TMPL \
+            .replace('{{email_image_url}}', msg_variables_tmpl.pop('email_image_url'))
+
+    def build(self, person):
+        name, amount, recipient_id = person.name, str(to_bip(person.amount_pip)), str(person.id)
+        msg_variables = {
+            k: v.format(name=name, company=self.company, amount=amount)
+            for k, v in self.msg_variables_tmpl.items()
         }
-        msg_variables_tmpl.update(**{k: v for k, v in changes.items() if v is not None})
-    msg_variables = {
-        k: v.format(name=name, company=company, amount=amount)
-        for k, v in msg_variables_tmpl.items()
-    }
-
-    msg = MIMEMultipart()
-    msg['From'] = EMAIL_SENDER
-    msg['To'] = person.email
-    msg['Subject'] = msg_variables['email_subject_text']
-    html_body = SHARING_MSG_TMPL \
-        .replace('{{email_image_url}}', msg_variables['email_image_url']) \
-        .replace('{{email_head_text}}', msg_variables['email_head_text']) \
-        .replace('{{email_body_text}}', msg_variables['email_body_text']) \
-        .replace('{{email_button_text}}', msg_variables['email_button_text']) \
-        .replace('{{token}}', person.wallet_link_id + person.target_route) \
-        .replace('{{recipient_id}}', recipient_id)
-    msg.attach(MIMEText(html_body, 'html'))
-    return msg
+
+        msg = MIMEMultipart()
+        msg['From'] = EMAIL_SENDER
+        msg['To'] = person.email
+        msg['Subject'] = msg_variables['email_subject_text']
+        html_body = self.html_tmpl \
+            .replace('{{email_head_text}}', msg_variables['email_head_text']) \
+            .replace('{{email_body_text}}', msg_variables['email_body_text']) \
+            .replace('{{email_button_text}}', msg_variables['email_button_text']) \
+            .replace('{{token}}', person.wallet_link_id + person.target_route) \
+            .replace('{{recipient_id}}', recipient_id)
+        msg.attach(MIMEText(html_body, 'html'))
+        return msg
+
+
+def mark_sent(campaign, recipient_ids):
+    if not recipient_ids:
+        return
+    Recipient \
+        .update(sent_at=datetime.utcnow()) \
+        .where(Recipient.id.in_(recipient_ids)) \
+        .execute()
+    stats = campaign_stats[campaign.id]
+    stats['sent'] += len(recipient_ids)
+    stats['per_second'] = round(stats['sent'] / (monotonic() - stats['started']), 2)
+    metrics.incr('mailer.sent', len(recipient_ids))
+
+
+def mark_failed(campaign, person, exc):
+    Recipient.update(send_error=str(exc)[:1000]).where(Recipient.id == person.id).execute()
+    campaign_stats[campaign.id]['failed'] += 1
+    metrics.incr('mailer.failed')
+    logging.info(f'[Campaign {campaign.company}] failed to send email to {person.email}: {exc}')
 
 
 def send_mail(campaign):
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-        server.starttls()
-        server.login(EMAIL_SENDER, EMAIL_PASS)
+    """
+    Deliver campaign emails through SMTP pool.
+    Recipients which are sent or failed are skipped, so interrupted campaign may be sent again safely.
+    """
+    with Heartbeat(PushCampaign, campaign.id):
+        _send_mail(campaign)
 
-        for person in campaign.recipients:
-            msg = build_custom_email(person, campaign)
-            server.send_message(msg)
-            person.sent_at = datetime.utcnow()
-            person.save()
-            logging.info(f'[Campaign {campaign.company}] sent email to {person.email}')
 
-        campaign.status = 'completed'
-        campaign.save()
+def _send_mail(campaign):
+    email = CampaignEmail(campaign)
+    pending = list(campaign.recipients.where(Recipient.sent_at.is_null() & Recipient.send_error.is_null()))
+    stats = campaign_stats[campaign.id] = {
+        'total': len(pending), 'sent': 0, 'failed': 0, 'retried': 0,
+        'per_second': 0, 'started': monotonic()}
+
+    pool = SMTPPool()
+    try:
+        attempt = 0
+        while pending:
+            if attempt:
+                sleep(RETRY_BACKOFF * attempt)
+            futures = {pool.submit(email.build, person): person for person in pending}
+            sent, pending = [], []
+            for future in as_completed(futures):
+                person = futures[future]
+                exc = future.exception()
+                if exc is None:
+                    sent.append(person.id)
+                    if len(sent) >= SENT_AT_FLUSH_SIZE:
+                        mark_sent(campaign, sent)
+                        sent = []
+                elif is_transient(exc) and attempt < SMTP_MAX_RETRIES:
+                    pending.append(person)
+                else:
+                    mark_failed(campaign, person, exc)
+            mark_sent(campaign, sent)
+            stats['retried'] += len(pending)
+            metrics.incr('mailer.retried', len(pending))
+            attempt += 1
+    finally:
+        pool.close()
+
+    logging.info(
+        f'[Campaign {campaign.company}] sent {stats["sent"]}/{stats["total"]} emails '
+        f'({stats["per_second"]}/s), failed {stats["failed"]}')
+    delivered = campaign.recipients.where(Recipient.sent_at.is_null(False)).exists()
+    campaign.status = 'completed' if delivered else 'failed'
+    campaign.save(only=[PushCampaign.status])
 
 
 @scheduler.scheduled_job('interval', seconds=30, disable_dev=True)
 def job_execute_campaigns():
+    """ Start paid campaigns and resume ones abandoned by crashed/restarted worker """
+    now = datetime.utcnow()
+    can_start = (PushCampaign.status == 'paid') | (
+        (PushCampaign.status == 'progress') &
+        (PushCampaign.heartbeat.is_null() | (PushCampaign.heartbeat < now - CAMPAIGN_STALE)))
     to_start = PushCampaign \
         .select(PushCampaign, PushWallet) \
         .join(PushWallet, on=PushCampaign.wallet_link_id == PushWallet.link_id) \
-        .where(PushCampaign.status == 'paid')
+        .where(can_start)
 
     for campaign in to_start:
-        campaign.status = 'progress'
-        campaign.save()
+        # job runs in every worker, campaign is sent by the one which changed its status
+        claimed = PushCampaign \
+            .update(status='progress', heartbeat=now) \
+            .where((PushCampaign.id == campaign.id) & can_start) \
+            .execute()
+        if not claimed:
+            continue
+        if campaign.status == 'progress':
+            logging.info(f'[Campaign {campaign.company}] resuming abandoned campaign {campaign.id}')
+        campaign.status, campaign.heartbeat = 'progress', now
         scheduler.add_job(send_mail, 'date', args=(campaign,))
 
 
@@ -104,9 +291,7 @@ def send_gratz_notification(order_id, api_response, product_name):
         contact=order.contact,
         api_response=api_response)
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-        server.starttls()
-        server.login(EMAIL_SENDER, EMAIL_PASS)
+    with smtp_connect() as server:
         for email in [GRATZ_OWNER_EMAIL, DEV_EMAIL]:
             server.sendmail(EMAIL_SENDER, email, message)
         order.notified = True
@@ -115,3 +300,9 @@ def send_gratz_notification(order_id, api_response, product_name):
 
 def schedule_gratz_notification(order_id, api_response, product_name):
     scheduler.add_job(send_gratz_notification, 'date', args=(order_id, api_response, product_name))
+
+
+metrics.gauge('mailer.campaigns', lambda: {
+    campaign_id: {k: v for k, v in stats.items() if k != 'started'}
+    for campaign_id, stats in list(campaign_stats.items())
+})
@@ -0,0 +1,208 @@
+import logging
+from datetime import datetime, timedelta
+
+from mintersdk.shortcuts import to_bip
+
+from api.models import PendingPayout, PushWallet, RewardCampaign, db
+from jobs.scheduler import scheduler
+from minter.api import MinterAPIException
+from minter.confirm import normalize_hash
+from minter.consts import INSUFFICIENT_FUNDS_CODE, TX_TRACK_TTL
+from minter.keys import get_private_key
+from minter.tx import multisend_coin_tx, get_tx_hash
+from providers.minter import send_tx_pipelined, reset_nonce
+from providers.nodeapi import NodeAPI
+
+PAYOUT_BATCH_WINDOW = 3
+PAYOUT_FLUSH_LIMIT = 1000
+PAYOUT_MAX_ATTEMPTS = 5
+MULTISEND_MAX_RECIPIENTS = 100
+# batch is resolved by tracker of the worker which sent it, after this it's checked on node by hash
+PAYOUT_STALE = timedelta(seconds=TX_TRACK_TTL)
+
+
+def get_source_private_key(address):
+    owner = PushWallet.get_or_none(address=address) or RewardCampaign.get_or_none(address=address)
+    if not owner:
+        return None
+    return get_private_key(owner)
+
+
+def same_tx(tx_hash):
+    """ Payouts weren't sent again since the batch `tx_hash` (None - batch which wasn't signed) """
+    return PendingPayout.tx_hash.is_null() if tx_hash is None else PendingPayout.tx_hash == tx_hash
+
+
+def retry_payouts(ids, only=None):
+    """
+    Batch didn't get into the blockchain: back to queue, failed after PAYOUT_MAX_ATTEMPTS
+    :param only: extra condition, for payouts which may be taken by another worker meanwhile
+    """
+    in_flight = PendingPayout.id.in_(ids) & PendingPayout.status.in_(['sending', 'sent'])
+    if only is not None:
+        in_flight &= only
+    PendingPayout \
+        .update(status='pending', tx_hash=None, nonce=None, sent_at=None, attempts=PendingPayout.attempts + 1) \
+        .where(in_flight) \
+        .execute()
+    PendingPayout \
+        .update(status='failed') \
+        .where(
+            PendingPayout.id.in_(ids) & (PendingPayout.status == 'pending') &
+            (PendingPayout.attempts >= PAYOUT_MAX_ATTEMPTS)) \
+        .execute()
+
+
+def resolve_batch(ids, tx_hash, status, log=None):
+    """ Apply tx result to payouts of the batch """
+    if status == 'confirmed':
+        PendingPayout \
+            .update(status='confirmed', confirmed_at=datetime.utcnow()) \
+            .where(PendingPayout.id.in_(ids) & PendingPayout.status.in_(['sending', 'sent']) & same_tx(tx_hash)) \
+            .execute()
+    elif status == 'failed':
+        # failed tx is in block, nonce is used and nothing is transferred: safe to send again
+        logging.info(f'[Payouts] batch {tx_hash} failed: {log}')
+        retry_payouts(ids, only=same_tx(tx_hash))
+
+
+def on_batch_resolved(ids):
+    def callback(pending):
+        tx_hash = 'Mt' + pending.hash
+        if pending.status == 'expired':
+            # tx may still get into a block later, sending it again could pay twice
+            logging.info(f'[Payouts] batch {tx_hash} expired, will be checked by resolve_stale_payouts')
+            return
+        resolve_batch(ids, tx_hash, pending.status, log=pending.log)
+    return callback
+
+
+def check_stale_batch(source_address, tx_hash, nonce, ids):
+    """ Batch which wasn't resolved by tracker (sending worker crashed, broadcast result unknown, tx expired) """
+    if tx_hash is None:
+        # claimed but never signed
+        retry_payouts(ids, only=same_tx(None) & (PendingPayout.sent_at < datetime.utcnow() - PAYOUT_STALE))
+        return
+    # nonce is checked first: if the batch used it, it's already in a block when looked up
+    transaction_count = int(NodeAPI.get_balance(source_address)['transaction_count'])
+    try:
+        tx = NodeAPI.get_transaction(normalize_hash(tx_hash))
+    except MinterAPIException:
+        tx = None
+    if tx:
+        code = int(tx.get('code') or 0)
+        resolve_batch(ids, tx_hash, 'confirmed' if code == 0 else 'failed', log=tx.get('log'))
+        return
+
+    if transaction_count >= nonce:
+        # nonce is taken by another tx, this one will never get into a block
+        logging.info(f'[Payouts] batch {tx_hash} was not sent, {len(ids)} payouts go back to queue')
+        retry_payouts(ids, only=same_tx(tx_hash))
+    else:
+        # next tx from the wallet takes the nonce, after that the batch is sent again
+        reset_nonce(source_address)
+
+
+def resolve_stale_payouts(limit=PAYOUT_FLUSH_LIMIT):
+    stale = PendingPayout \
+        .select() \
+        .where(
+            PendingPayout.status.in_(['sending', 'sent']) &
+            (PendingPayout.sent_at < datetime.utcnow() - PAYOUT_STALE)) \
+        .order_by(PendingPayout.id) \
+        .limit(limit)
+    batches = {}
+    for payout in stale:
+        batches.setdefault((payout.source_address, payout.tx_hash, payout.nonce), []).append(payout.id)
+    for (source_address, tx_hash, nonce), ids in batches.items():
+        try:
+            check_stale_batch(source_address, tx_hash, nonce, ids)
+        except Exception:
+            logging.exception(f'[Payouts] {source_address}: stale batch {tx_hash} not checked')
+
+
+def send_payout_batch(source_address, coin, payouts):
+    ids = [p.id for p in payouts]
+    try:
+        private_key = get_source_private_key(source_address)
+        if not private_key:
+            logging.info(f'[Payouts] unknown source wallet {source_address}')
+            PendingPayout.update(status='failed').where(PendingPayout.id.in_(ids)).execute()
+            return
+        txs = [{'coin': coin, 'to': p.to, 'value': to_bip(p.amount_pip)} for p in payouts]
+    except Exception:
+        logging.exception(f'[Payouts] {source_address}: batch of {len(ids)} not sent')
+        retry_payouts(ids)
+        return
+
+    def make_tx(nonce):
+        tx = multisend_coin_tx(private_key, txs, nonce, gas_coin=coin)
+        # hash is saved before broadcast, so batch in unknown state can be checked on node later
+        PendingPayout \
+            .update(tx_hash='Mt' + get_tx_hash(tx), nonce=nonce, sent_at=datetime.utcnow()) \
+            .where(PendingPayout.id.in_(ids) & (PendingPayout.status == 'sending')) \
+            .execute()
+        return tx
+
+    try:
+        pending = send_tx_pipelined(source_address, make_tx, callback=on_batch_resolved(ids))
+    except MinterAPIException as exc:
+        if str(exc.code) == str(INSUFFICIENT_FUNDS_CODE) and len(payouts) > 1:
+            # send the part balance covers, the tail goes back to queue
+            half = len(payouts) // 2
+            logging.info(f'[Payouts] {source_address}: not enough balance for {len(ids)}, sending {half}')
+            retry_payouts(ids[half:])
+            send_payout_batch(source_address, coin, payouts[:half])
+            return
+        logging.info(f'[Payouts] {source_address}: batch of {len(ids)} failed: {exc.message}')
+        retry_payouts(ids)
+        return
+    except Exception:
+        # node may have got the tx (read timeout etc.), batch is checked by hash when it gets stale
+        logging.exception(f'[Payouts] {source_address}: batch of {len(ids)} ({ids}) in unknown state')
+        return
+
+    # tracker callback may have resolved the batch already
+    PendingPayout \
+        .update(status='sent') \
+        .where(PendingPayout.id.in_(ids) & (PendingPayout.status == 'sending')) \
+        .execute()
+    logging.info(f'[Payouts] {source_address}: sent {len(ids)} {coin} transfers in Mt{pending.hash}')
+
+
+def claim_payouts(limit=PAYOUT_FLUSH_LIMIT):
+    """ Take pending payouts for sending, rows claimed by one worker are skipped by others """
+    with db.database.atomic():
+        to_send = list(PendingPayout
+                       .select()
+                       .where(PendingPayout.status == 'pending')
+                       .order_by(PendingPayout.id)
+                       .limit(limit)
+                       .for_update('FOR UPDATE SKIP LOCKED'))
+        if to_send:
+            PendingPayout \
+                .update(status='sending', sent_at=datetime.utcnow()) \
+                .where(PendingPayout.id.in_([p.id for p in to_send])) \
+                .execute()
+    return to_send
+
+
+@scheduler.scheduled_job('interval', seconds=PAYOUT_BATCH_WINDOW)
+def job_flush_payouts():
+    # every batch is sent and saved separately, outside of claiming transaction
+    batches = {}
+    for payout in claim_payouts():
+        batches.setdefault((payout.source_address, payout.coin), []).append(payout)
+
+    for (source_address, coin), payouts in batches.items():
+        for i in range(0, len(payouts), MULTISEND_MAX_RECIPIENTS):
+            batch = payouts[i:i + MULTISEND_MAX_RECIPIENTS]
+            try:
+                send_payout_batch(source_address, coin, batch)
+            except Exception:
+                logging.exception(f'[Payouts] {source_address}: batch of {len(batch)} not saved')
+
+
+@scheduler.scheduled_job('interval', minutes=1)
+def job_resolve_stale_payouts():
+    resolve_stale_payouts()
@@ -0,0 +1,7 @@
+from jobs.scheduler import scheduler
+from providers.currency_rates import refresh_rates, ONE_MINUTE
+
+
+@scheduler.scheduled_job('interval', seconds=ONE_MINUTE)
+def job_refresh_rates():
+    refresh_rates()
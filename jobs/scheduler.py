@@ -1,9 +1,24 @@
+from functools import wraps
+
 from apscheduler.schedulers.background import BackgroundScheduler
 
+from api.models import db
 from config import DEV
 
 
+def with_db_connection(func):
+    """ Job takes connection from the pool and returns it when done, like a request does """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with db.database.connection_context():
+            return func(*args, **kwargs)
+    return wrapper
+
+
 class YYYScheduler(BackgroundScheduler):
+    def add_job(self, func, *args, **kwargs):
+        return super().add_job(with_db_connection(func), *args, **kwargs)
+
     def scheduled_job(self, *args, disable_dev=False, **kwargs):
         if DEV and disable_dev:
             return lambda fn: fn
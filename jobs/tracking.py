@@ -0,0 +1,60 @@
+"""
+Email open tracking: pixel requests only put recipient id into in-process buffer,
+which is written to DB with one UPDATE every few seconds.
+"""
+import logging
+from datetime import datetime
+from threading import Lock
+
+from peewee import ValuesList
+
+from api.models import Recipient
+from helpers.metrics import metrics
+from jobs.scheduler import scheduler
+
+OPENS_FLUSH_INTERVAL = 3
+OPENS_BUFFER_LIMIT = 100000
+MAX_RECIPIENT_ID = 2 ** 31 - 1
+
+_opens_lock = Lock()
+_opens = {}
+
+
+def track_open(mail_stat_id):
+    """ Remember first open time of recipient. Invalid ids are ignored """
+    if not mail_stat_id.isdigit() or int(mail_stat_id) > MAX_RECIPIENT_ID:
+        return
+    with _opens_lock:
+        if len(_opens) >= OPENS_BUFFER_LIMIT:
+            metrics.incr('tracking.opens_dropped')
+            return
+        _opens.setdefault(int(mail_stat_id), datetime.utcnow())
+
+
+def flush_opens():
+    global _opens
+    with _opens_lock:
+        opens, _opens = _opens, {}
+    if not opens:
+        return
+
+    values = ValuesList(list(opens.items()), columns=('id', 'opened_at'), alias='opens')
+    try:
+        # unknown ids just don't match, already opened recipients keep the first open time
+        updated = Recipient \
+            .update(opened_at=values.c.opened_at) \
+            .from_(values) \
+            .where((Recipient.id == values.c.id) & Recipient.opened_at.is_null()) \
+            .execute()
+    except Exception:
+        with _opens_lock:
+            for recipient_id, opened_at in opens.items():
+                _opens.setdefault(recipient_id, opened_at)
+        raise
+    metrics.incr('tracking.opens', updated)
+    logging.info(f'Email opens flushed: {updated} of {len(opens)} tracked')
+
+
+@scheduler.scheduled_job('interval', seconds=OPENS_FLUSH_INTERVAL)
+def job_flush_opens():
+    flush_opens()
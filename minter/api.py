@@ -1,10 +1,14 @@
 import logging
-from time import sleep
+import os
 
 from mintersdk.minterapi import MinterAPI
-from requests import ReadTimeout, ConnectTimeout, HTTPError
+from requests import ReadTimeout, ConnectTimeout, HTTPError, Session, ConnectionError as RequestsConnectionError
+from requests.adapters import HTTPAdapter
 
+from helpers.metrics import metrics
 from helpers.misc import retry
+from minter.confirm import TxTracker
+from minter.consts import TX_CONFIRM_TIMEOUT, TX_TRACK_TTL
 
 
 class MinterAPIException(Exception):
@@ -14,23 +18,60 @@ class MinterAPIException(Exception):
         self.message = err.get('tx_result', {}).get('log') or err.get('message')
 
 
+class TxConfirmationTimeout(MinterAPIException):
+    def __init__(self, tx_hash, timeout):
+        super().__init__({'error': {'message': f'Transaction Mt{tx_hash} is not confirmed in {timeout} seconds'}})
+
+
 class CustomMinterAPI(MinterAPI):
     """
     Грубая обертка над MinterAPI из U-Node SDK
+       - ходит в API через один requests.Session на процесс (keep-alive, ограниченный пул соединений)
        - делает повторные попытки запросов, если API не отвечает
        - при успешном результате возвращает содержимое ключа 'result'
        - MinterAPIException только в случае отсутствия ключа 'result' в ответе API
+       - пишет latency каждого эндпоинта в метрики (node_api.<command>)
 
     send_tx:
-       - возвращает hash с привычным префикcом Mt + хэш транзакции в lowercase
-       - то же что send_transaction, а если wait=True - ждет успешного выполнения транзакции
+       - то же что send_transaction, но возвращает PendingTx (см. minter.confirm)
+       - если wait=True - ждет подтверждения не дольше timeout секунд:
+         TxConfirmationTimeout если не дождались, MinterAPIException если транзакция упала
     """
-    to_handle = ReadTimeout, ConnectTimeout, ConnectionError, HTTPError, ValueError, KeyError
+    to_handle = ReadTimeout, ConnectTimeout, ConnectionError, RequestsConnectionError, HTTPError, ValueError, KeyError
     headers = {}
 
+    def __init__(self, api_url, pool_size=10, timeout=(3, 10), **kwargs):
+        super().__init__(api_url, **kwargs)
+        self.base_url = api_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session_headers = kwargs.get('headers') or {}
+        self._session = None
+        self._session_pid = None
+        self.tracker = TxTracker(self, ttl=TX_TRACK_TTL)
+
+    @property
+    def session(self):
+        # gunicorn forks workers: every process should have its own connections
+        if self._session is None or self._session_pid != os.getpid():
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(self.session_headers)
+            self._session, self._session_pid = session, os.getpid()
+        return self._session
+
     @retry(to_handle, tries=3, delay=0.5, backoff=2)
     def _request(self, command, request_type='get', **kwargs):
-        r = super()._request(command, request_type=request_type, **kwargs)
+        url = f"{self.base_url}/{command.lstrip('/')}"
+        try:
+            with metrics.timer(f'node_api.{command}'):
+                response = self.session.request(request_type, url, timeout=self.timeout, **kwargs)
+            r = response.json()
+        except self.to_handle:
+            metrics.incr(f'node_api.{command}.errors')
+            raise
         if 'result' not in r:
             logging.info(f'Minter API Exception {r}')
             raise MinterAPIException(r)
@@ -41,18 +82,15 @@ class CustomMinterAPI(MinterAPI):
             return []
         return self._request('addresses', params={'addresses': str(addresses).replace("'", '"')})
 
-    def send_tx(self, tx, wait=False):
+    def get_latest_block_height(self):
+        return int(self._request('status')['latest_block_height'])
+
+    def send_tx(self, tx, wait=False, timeout=TX_CONFIRM_TIMEOUT, callback=None):
         r = super().send_transaction(tx.signed_tx)
+        pending = self.tracker.track(r['hash'], callback=callback)
         if wait:
-            self._wait_tx(r['hash'].lower())
-        r['hash'] = 'Mt' + r['hash'].lower()
-        return r
-
-    def _wait_tx(self, tx_hash):
-        while True:
-            try:
-                self.get_transaction(tx_hash)
-            except MinterAPIException:
-                sleep(1)
-                continue
-            break
+            if not pending.wait(timeout):
+                raise TxConfirmationTimeout(pending.hash, timeout)
+            if pending.status != 'confirmed':
+                raise MinterAPIException({'error': {'code': pending.code, 'message': pending.log or pending.status}})
+        return pending
@@ -0,0 +1,194 @@
+"""
+Confirmation of sent transactions without busy polling in request handlers.
+
+One poller thread per process walks new blocks and resolves every pending hash found in them,
+so the number of node requests depends on the number of blocks, not on the number of waiters.
+Callers get a PendingTx and either wait for it with a deadline or attach a callback.
+"""
+import logging
+import os
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from cachetools import TTLCache
+
+
+def normalize_hash(tx_hash):
+    tx_hash = tx_hash.lower()
+    return tx_hash[2:] if tx_hash.startswith('mt') else tx_hash
+
+
+class PendingTx:
+    """
+    Handle of a sent transaction.
+    status: pending -> confirmed | failed | expired
+    """
+
+    def __init__(self, tx_hash, since_height=None, callback=None):
+        self.hash = normalize_hash(tx_hash)
+        self.since_height = since_height
+        self.created_at = monotonic()
+        self.status = 'pending'
+        self.block = None
+        self.code = None
+        self.log = None
+        self._event = Event()
+        self._callbacks = [callback] if callback else []
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """ Returns True if tx is resolved (confirmed, failed or expired) before the deadline """
+        return self._event.wait(timeout)
+
+    def add_callback(self, fn):
+        if self.done:
+            self._run_callback(fn)
+            return
+        self._callbacks.append(fn)
+
+    def resolve(self, status, block=None, code=None, log=None):
+        self.status, self.block, self.code, self.log = status, block, code, log
+        self._event.set()
+        for fn in self._callbacks:
+            self._run_callback(fn)
+        self._callbacks = []
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logging.exception(f'Tx {self.hash} callback failed')
+
+    def to_dict(self):
+        return {
+            'hash': 'Mt' + self.hash,
+            'status': self.status,
+            'block': self.block,
+            'code': self.code,
+            'log': self.log
+        }
+
+
+class TxTracker:
+    """
+    Process-wide registry of pending transactions.
+    Blocks are fetched once and kept for a while, so hashes tracked later
+    are still found in blocks which were already scanned.
+    """
+
+    def __init__(self, api, poll_interval=1, ttl=600, blocks_to_keep=120):
+        self.api = api
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.blocks_to_keep = blocks_to_keep
+        self._pending = {}
+        self._resolved = TTLCache(maxsize=10000, ttl=ttl)
+        self._blocks = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._thread_pid = None
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def track(self, tx_hash, callback=None):
+        tx_hash = normalize_hash(tx_hash)
+        with self._lock:
+            tracked = self._pending.get(tx_hash) or self._resolved.get(tx_hash)
+        if tracked:
+            if callback:
+                tracked.add_callback(callback)
+            return tracked
+
+        pending = PendingTx(tx_hash, since_height=self._latest_height(), callback=callback)
+        with self._lock:
+            self._pending[tx_hash] = pending
+            self._ensure_poller()
+        self._wakeup.set()
+        return pending
+
+    def get(self, tx_hash):
+        tx_hash = normalize_hash(tx_hash)
+        with self._lock:
+            return self._pending.get(tx_hash) or self._resolved.get(tx_hash)
+
+    def _latest_height(self):
+        try:
+            return self.api.get_latest_block_height()
+        except Exception as exc:
+            logging.info(f'TxTracker: latest block height unavailable ({exc})')
+            return None
+
+    def _ensure_poller(self):
+        # gunicorn forks workers: every process should run its own poller
+        if self._thread and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        self._thread = Thread(target=self._run, name='tx-tracker', daemon=True)
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self._poll()
+            except Exception:
+                logging.exception('TxTracker poll failed')
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _poll(self):
+        latest = self._latest_height()
+        if latest is None:
+            return
+        with self._lock:
+            pending = list(self._pending.values())
+        if not pending:
+            return
+
+        first = min(p.since_height or latest - 1 for p in pending)
+        for height in range(max(first, latest - self.blocks_to_keep), latest + 1):
+            if height in self._blocks:
+                continue
+            try:
+                block = self.api.get_block(height)
+            except Exception as exc:
+                logging.info(f'TxTracker: block {height} unavailable ({exc})')
+                break
+            self._blocks[height] = {
+                normalize_hash(tx['hash']): (int(tx.get('code') or 0), tx.get('log'))
+                for tx in block.get('transactions') or []
+            }
+        for height in [h for h in self._blocks if h < latest - self.blocks_to_keep]:
+            del self._blocks[height]
+
+        now = monotonic()
+        for p in pending:
+            found = self._find(p)
+            if found:
+                height, code, log = found
+                self._finish(p, 'confirmed' if code == 0 else 'failed', block=height, code=code, log=log)
+            elif now - p.created_at > self.ttl:
+                self._finish(p, 'expired')
+
+    def _find(self, pending):
+        for height in sorted(self._blocks):
+            if pending.since_height and height < pending.since_height:
+                continue
+            if pending.hash in self._blocks[height]:
+                code, log = self._blocks[height][pending.hash]
+                return height, code, log
+
+    def _finish(self, pending, status, **kwargs):
+        with self._lock:
+            self._pending.pop(pending.hash, None)
+            self._resolved[pending.hash] = pending
+        pending.resolve(status, **kwargs)
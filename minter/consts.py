@@ -5,6 +5,16 @@ from mintersdk.sdk.transactions import MinterSendCoinTx, MinterSellCoinTx, Minte
 from config import TESTNET
 
 MIN_RESERVE_BIP = 10000
+# coin info, sell and fee estimates are reused for about one block
+COIN_CACHE_TTL = 5
+# latest block height is polled at most once per this interval
+BLOCK_HEIGHT_TTL = 1
+# how long send_tx(wait=True) waits for a block with the tx, seconds
+TX_CONFIRM_TIMEOUT = 30
+# how long unconfirmed tx is tracked before it is considered expired, seconds
+TX_TRACK_TTL = 10 * 60
+# node response code: not enough coins to pay the value and commission
+INSUFFICIENT_FUNDS_CODE = 107
 BASE_COIN = 'MNT' if TESTNET else 'BIP'
 TX_TYPES = {
     'send':	MinterSendCoinTx,
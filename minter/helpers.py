@@ -1,21 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
+from cachetools.func import ttl_cache
 from mintersdk.shortcuts import to_bip, to_pip
 from mintersdk.sdk.deeplink import MinterDeeplink
 
-from minter.consts import BASE_COIN, TX_TYPES, MIN_RESERVE_BIP
-from minter.tx import estimate_custom_fee
+from minter.consts import BASE_COIN, TX_TYPES, COIN_CACHE_TTL
+from minter.tx import estimate_custom_fee, is_reserve_sufficient
 from providers.nodeapi import NodeAPI
 
+VALUATION_WORKERS = 8
+_valuation_pool = ThreadPoolExecutor(max_workers=VALUATION_WORKERS, thread_name_prefix='valuation')
+
+
+@ttl_cache(maxsize=1024, ttl=COIN_CACHE_TTL)
+def estimate_sell_to_base(coin, value_pip):
+    return NodeAPI.estimate_coin_sell(coin, value_pip, BASE_COIN)
+
+
+def _valuate_coin(coin, balance_pip, payload=''):
+    """
+    Resolve everything needed about one coin of a wallet:
+    (effective value in BIP or None, tx fee in this coin or None, reserve ok)
+    """
+    tx_fee = estimate_custom_fee(coin, payload=payload)
+    if coin == BASE_COIN:
+        return max(Decimal(0), to_bip(balance_pip) - Decimal('0.01')), tx_fee, True
+
+    # ROUBLE WORKAROUND
+    if not is_reserve_sufficient(coin):
+        return None, tx_fee, False
+
+    est_sell_response = estimate_sell_to_base(coin, balance_pip)
+    will_get_pip, comm_pip = est_sell_response['will_get'], est_sell_response['commission']
+    if int(balance_pip) < int(comm_pip):
+        return None, tx_fee, True
+    will_get_pip = int(will_get_pip) - to_pip(0.01)
+    return (to_bip(will_get_pip) if will_get_pip > 0 else None), tx_fee, True
+
+
+class BalanceValuation:
+    """
+    All node-dependent numbers for one wallet balance, resolved once:
+       - balances: raw balances in pip, as returned by node
+       - balances_bip: effective balance of every coin in BIP (see effective_balance)
+       - fees: tx fee for every coin paid in this coin (None if coin can't pay fees)
+
+    Coins are resolved concurrently, node answers are cached per coin for about one block.
+    """
+
+    def __init__(self, balances, payload=''):
+        self.balances = balances
+        self.payload = payload
+
+        coins = list(balances.items())
+        if len(coins) > 1:
+            resolved = list(_valuation_pool.map(lambda item: _valuate_coin(*item, payload=payload), coins))
+        else:
+            resolved = [_valuate_coin(coin, balance, payload=payload) for coin, balance in coins]
+
+        self.fees = {coin: tx_fee for (coin, _), (_, tx_fee, _) in zip(coins, resolved)}
+        balances_bip = {}
+        for (coin, _), (value_bip, _, reserve_ok) in zip(coins, resolved):
+            if not reserve_ok:
+                balances_bip = {coin: Decimal(0)}
+                break
+            if value_bip is not None:
+                balances_bip[coin] = value_bip
+        self.balances_bip = balances_bip or {'BIP': Decimal(0)}
+
+    @property
+    def main_coin(self):
+        return max(self.balances_bip.items(), key=lambda i: i[1])[0]
+
+    @property
+    def main_balance_bip(self):
+        return self.balances_bip[self.main_coin]
+
+    @property
+    def gas(self):
+        """ (coin, fee) of the first coin able to pay fee for itself, (None, None) if there is none """
+        for coin, balance_pip in self.balances.items():
+            tx_fee = self.fees.get(coin)
+            if not tx_fee:
+                continue
+            if to_bip(balance_pip) - tx_fee >= 0:
+                return coin, tx_fee
+        return None, None
+
+    def effective_value(self, value, coin):
+        tx_fee = self.fees[coin] if coin in self.fees else estimate_custom_fee(coin, payload=self.payload)
+        if tx_fee is None:
+            return value
+        if tx_fee >= value:
+            return Decimal(0)
+        return Decimal(value) - tx_fee
+
+
+def valuate_balances(balances, payload=''):
+    return BalanceValuation(balances, payload=payload)
+
 
 def find_gas_coin(balances, get_fee=False, payload=''):
-    for coin, balance_pip in balances.items():
-        tx_fee = estimate_custom_fee(coin, payload=payload)
-        if not tx_fee:
-            continue
-        if to_bip(balance_pip) - tx_fee >= 0:
-            return coin if not get_fee else (coin, tx_fee)
-    return None if not get_fee else (None, None)
+    gas_coin, tx_fee = valuate_balances(balances, payload=payload).gas
+    return gas_coin if not get_fee else (gas_coin, tx_fee)
 
 
 def effective_value(value, coin):
@@ -28,25 +116,7 @@ def effective_value(value, coin):
 
 
 def effective_balance(balances):
-    balances_bip = {}
-    for coin, balance in balances.items():
-        if coin == BASE_COIN:
-            balances_bip[coin] = max(Decimal(0), to_bip(balance) - Decimal('0.01'))
-            continue
-
-        # ROUBLE WORKAROUND
-        coin_info = NodeAPI.get_coin_info(coin)
-        if coin_info['reserve_balance'] < to_pip(Decimal(MIN_RESERVE_BIP) + Decimal('0.01')):
-            return {coin: Decimal(0)}
-
-        est_sell_response = NodeAPI.estimate_coin_sell(coin, balance, BASE_COIN)
-        will_get_pip, comm_pip = est_sell_response['will_get'], est_sell_response['commission']
-        if int(balance) < int(comm_pip):
-            continue
-        will_get_pip = int(will_get_pip) - to_pip(0.01)
-        if will_get_pip > 0:
-            balances_bip[coin] = to_bip(will_get_pip)
-    return balances_bip or {'BIP': Decimal(0)}
+    return valuate_balances(balances).balances_bip
 
 
 class TxDeeplink(MinterDeeplink):
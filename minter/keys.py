@@ -0,0 +1,75 @@
+"""
+Private keys of push wallets and reward campaigns.
+
+Deriving key from mnemonic (BIP39 seed) is slow, so it's done once: derived key is stored
+encrypted in `private_key_enc` next to the mnemonic, and hot decrypted keys are kept in bounded LRU.
+Wallets created before keys were stored get `private_key_enc` on first use,
+keys which can't be decrypted (encrypted with another secret) are derived and encrypted again.
+"""
+import base64
+import hashlib
+import logging
+from threading import Lock
+
+from cachetools import LRUCache
+from cryptography.fernet import Fernet, InvalidToken
+from mintersdk.sdk.wallet import MinterWallet
+
+from config import KEY_ENCRYPTION_SECRET
+
+PRIVATE_KEY_CACHE_SIZE = 1024
+
+_fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(KEY_ENCRYPTION_SECRET.encode()).digest())) \
+    if KEY_ENCRYPTION_SECRET else None
+if _fernet is None:
+    logging.error('KEY_ENCRYPTION_SECRET is not set: private keys are not stored and derived on every use')
+_keys = LRUCache(maxsize=PRIVATE_KEY_CACHE_SIZE)
+_keys_lock = Lock()
+
+
+def create_wallet_keys(_=None):
+    """ New wallet as (address, mnemonic, private_key), picklable for process pool """
+    wallet = MinterWallet.create()
+    return wallet['address'], wallet['mnemonic'], wallet['private_key']
+
+
+def encrypt_private_key(private_key):
+    if _fernet is None:
+        return None
+    return _fernet.encrypt(private_key.encode()).decode()
+
+
+def decrypt_private_key(private_key_enc):
+    return _fernet.decrypt(private_key_enc.encode()).decode()
+
+
+def get_private_key(owner):
+    """
+    :param owner: PushWallet or RewardCampaign
+    """
+    with _keys_lock:
+        private_key = _keys.get(owner.address)
+    if private_key:
+        return private_key
+
+    if owner.private_key_enc and _fernet is not None:
+        try:
+            private_key = decrypt_private_key(owner.private_key_enc)
+        except InvalidToken:
+            logging.warning(f"Can't decrypt private key of {owner.address}, deriving it from mnemonic")
+    if not private_key:
+        private_key = MinterWallet.create(mnemonic=owner.mnemonic)['private_key']
+        owner.private_key_enc = encrypt_private_key(private_key)
+        if owner.private_key_enc:
+            model = type(owner)
+            model.update(private_key_enc=owner.private_key_enc).where(model.id == owner.id).execute()
+
+    with _keys_lock:
+        _keys[owner.address] = private_key
+    return private_key
+
+
+def evict_private_key(address):
+    """ Drop decrypted key from memory, e.g. when wallet is emptied and not expected to be used again """
+    with _keys_lock:
+        _keys.pop(address, None)
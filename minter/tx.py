@@ -1,10 +1,15 @@
+import hashlib
 from decimal import Decimal
+from threading import Lock
 
+from cachetools import LRUCache
+from cachetools.func import ttl_cache
 from mintersdk import MinterHelper
-from mintersdk.sdk.transactions import MinterSendCoinTx, MinterTx
+from mintersdk.sdk.transactions import MinterSendCoinTx, MinterTx, MinterMultiSendCoinTx
 from mintersdk.sdk.wallet import MinterWallet
 from mintersdk.shortcuts import to_bip, to_pip
-from minter.consts import MIN_RESERVE_BIP, BASE_COIN
+from helpers.metrics import metrics
+from minter.consts import MIN_RESERVE_BIP, BASE_COIN, COIN_CACHE_TTL, BLOCK_HEIGHT_TTL
 from providers.nodeapi import NodeAPI
 
 
@@ -16,6 +21,20 @@ def send_coin_tx(pk, coin, value, to, nonce, gas_coin=BASE_COIN, payload=''):
     return tx
 
 
+def multisend_coin_tx(pk, txs, nonce, gas_coin=BASE_COIN, payload=''):
+    """ txs: [{'coin': ..., 'to': ..., 'value': <bip>}, ...] """
+    txs = [{**tx, 'to': tx['to'].strip()} for tx in txs]
+    tx = MinterMultiSendCoinTx(txs, nonce=nonce, gas_coin=gas_coin, payload=payload)
+    tx.sign(pk)
+    return tx
+
+
+def get_tx_hash(tx):
+    """ Hash of a signed tx (without prefix), known before it is sent """
+    signed_tx = tx.signed_tx[2:] if tx.signed_tx.startswith('0x') else tx.signed_tx
+    return hashlib.sha256(bytes.fromhex(signed_tx)).hexdigest()
+
+
 def estimate_payload_fee(payload, bip=False):
     fee_pip = MinterHelper.pybcmul(
         len(bytes(payload, encoding='utf-8')) * MinterTx.PAYLOAD_COMMISSION,
@@ -23,12 +42,77 @@ def estimate_payload_fee(payload, bip=False):
     return to_bip(fee_pip) if bip else fee_pip
 
 
+@ttl_cache(maxsize=256, ttl=COIN_CACHE_TTL)
+def get_coin_info(coin):
+    return NodeAPI.get_coin_info(coin)
+
+
+def is_reserve_sufficient(coin):
+    coin_info = get_coin_info(coin)
+    return int(coin_info['reserve_balance']) >= to_pip(Decimal(MIN_RESERVE_BIP) + Decimal('0.01'))
+
+
+class FeeOracle:
+    """
+    Commission of a send tx paid in custom coin.
+       - cached per (coin, payload length in bytes), valid until the next block
+       - dummy transactions for estimation are signed with one throwaway key
+       - hits/misses counters are available in `stats`
+    """
+    base_fee = Decimal('0.01')
+
+    def __init__(self, api, maxsize=1024):
+        self.api = api
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = Lock()
+        self._wallet = None
+
+    @property
+    def wallet(self):
+        if self._wallet is None:
+            self._wallet = MinterWallet.create()
+        return self._wallet
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def estimate(self, coin, payload=''):
+        if coin == BASE_COIN:
+            return self.base_fee
+        key = (coin, len(bytes(payload, encoding='utf-8')))
+        height = latest_block_height()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == height:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        fee = self._estimate(*key)
+        with self._lock:
+            self._cache[key] = (height, fee)
+        return fee
+
+    def _estimate(self, coin, payload_len):
+        if not is_reserve_sufficient(coin):
+            return
+        tx = send_coin_tx(
+            self.wallet['private_key'], coin, 0, self.wallet['address'], 1,
+            gas_coin=coin, payload='0' * payload_len)
+        return to_bip(self.api.estimate_tx_commission(tx.signed_tx)['commission'])
+
+
+@ttl_cache(maxsize=1, ttl=BLOCK_HEIGHT_TTL)
+def latest_block_height():
+    return NodeAPI.get_latest_block_height()
+
+
+fee_oracle = FeeOracle(NodeAPI)
+metrics.gauge('fee_oracle', lambda: fee_oracle.stats)
+
+
 def estimate_custom_fee(coin, payload=''):
-    if coin == BASE_COIN:
-        return Decimal('0.01')
-    coin_info = NodeAPI.get_coin_info(coin)
-    if coin_info['reserve_balance'] < to_pip(MIN_RESERVE_BIP + 0.01):
-        return
-    w = MinterWallet.create()
-    tx = send_coin_tx(w['private_key'], coin, 0, w['address'], 1, gas_coin=coin, payload=payload)
-    return to_bip(NodeAPI.estimate_tx_commission(tx.signed_tx)['commission'])
+    return fee_oracle.estimate(coin, payload=payload)
@@ -0,0 +1,244 @@
+"""
+Provider catalogs (GIFT, Gratz, Giftery) synced into Shop/Product tables, see jobs.catalog.
+
+Products are upserted by slug ('<provider>-<provider product id>'),
+products which are not in provider catalog anymore are deactivated.
+Provider catalog is fetched first and saved in its own short transaction,
+so failed or slow provider doesn't block the others.
+"""
+import logging
+from datetime import datetime
+
+from peewee import EXCLUDED
+
+from api.logic.core import invalidate_spend_catalog
+from api.models import db, User, Merchant, Brand, Shop, Product, Category, MerchantImage
+from helpers import shared_cache
+from mintersdk.shortcuts import to_pip
+from providers.currency_rates import fiat_to_bip
+from providers.giftery import GifteryAPIClient
+from providers.gratz import gratz_product_list
+
+CATALOG_SYNC_LOCK_ID = 0x63746c  # pg advisory lock key, sync job runs in every worker
+CATALOG_SYNC_KEY = 'catalog-synced'
+
+GIFT_PRODUCTS = ['y1000', 'y2000', 'y3000']
+
+PRODUCT_SYNC_FIELDS = [
+    Product.shop, Product.active, Product.product_type, Product.currency, Product.coin,
+    Product.title, Product.description, Product.price_fiat, Product.price_pip,
+    Product.price_list_fiat, Product.price_fiat_min, Product.price_fiat_max, Product.price_fiat_step]
+
+
+def product_row(**fields):
+    row = {field.name: field.default for field in PRODUCT_SYNC_FIELDS}
+    row.update({'product_type': 'certificate', 'active': True})
+    row.update(fields)
+    return row
+
+
+def sync_products(prefix, rows):
+    """
+    Upsert products by slug, deactivate products with `prefix` slug missing in `rows`
+    :return: {slug: id} of products created by this sync
+    """
+    slugs = [row['slug'] for row in rows]
+    existing = {product.slug for product in Product.select(Product.slug).where(Product.slug.in_(slugs or ['']))}
+    created = {}
+    if rows:
+        upserted = Product \
+            .insert_many(rows) \
+            .on_conflict(
+                conflict_target=[Product.slug],
+                update={field: getattr(EXCLUDED, field.column_name) for field in PRODUCT_SYNC_FIELDS}) \
+            .returning(Product.id, Product.slug) \
+            .tuples() \
+            .execute()
+        created = {slug: product_id for product_id, slug in upserted if slug not in existing}
+
+    Product \
+        .update(active=False) \
+        .where(Product.slug.startswith(prefix) & Product.slug.not_in(slugs or [''])) \
+        .execute()
+    return created
+
+
+def sync_gift(merchant, brand):
+    # GIFT has no catalog API: products are static, display price is converted from RUB,
+    # product which can't be ordered is hidden on purchase (see providers.gift) until next sync
+    with db.database.atomic():
+        food = Category.get(slug='food')
+        shop, _ = Shop.get_or_create(
+            name='Яндекс.Еда (GIFT)', brand=brand, merchant=merchant,
+            defaults={'integrated': True, 'active': True, 'in_moderation': False, 'category': food})
+
+        rows = []
+        for product in GIFT_PRODUCTS:
+            price = int(product[1:])
+            rows.append(product_row(
+                shop=shop.id, slug=f'gift-{product}', title=f'{price} RUB',
+                price_fiat=price, currency='RUB', price_pip=str(to_pip(fiat_to_bip(price, 'RUB')))))
+        sync_products('gift-', rows)
+        # products imported before sync had slugs without provider prefix
+        Product.update(active=False).where((Product.shop == shop) & ~Product.slug.startswith('gift-')).execute()
+
+
+def sync_gratz(merchant, brand):
+    gratz_products = gratz_product_list()
+    if isinstance(gratz_products, str):
+        logging.info(gratz_products)
+        return
+    gratz_products, _ = gratz_products
+    with db.database.atomic():
+        _save_gratz(merchant, brand, gratz_products)
+
+
+def _save_gratz(merchant, brand, gratz_products):
+    categories = {c.slug: c for c in Category.select()}
+    gratz_shops = {s.name: s for s in Shop.select().where(Shop.brand == brand)}
+
+    rows = []
+    for cat_slug, shops in gratz_products.items():
+        cat_model = categories.get(cat_slug)
+        if cat_slug == 'gas' and not cat_model:
+            cat_model = categories['gas'] = Category.create(slug='gas', title='АЗС', title_en='Gas')
+        if not cat_model:
+            logging.info(f'Bad category slug {cat_slug} (GRATZ)')
+            continue
+        for shop_name, products in shops.items():
+            shop_name = f'{shop_name} (GRATZ)'
+            shop_model = gratz_shops.get(shop_name)
+            if not shop_model:
+                shop_model = gratz_shops[shop_name] = Shop.create(
+                    name=shop_name,
+                    integrated=True, active=True, in_moderation=False,
+                    merchant=merchant, category=cat_model, brand=brand)
+
+            for product in products:
+                # price in BIP is known only after order is created, this one is for display
+                price_bip = fiat_to_bip(product['value'], 'UAH')
+                rows.append(product_row(
+                    shop=shop_model.id, slug=product['slug'], title=f"{product['value']} UAH",
+                    price_fiat=product['value'], currency='UAH', price_pip=str(to_pip(price_bip))))
+    sync_products('gratz-', rows)
+
+
+def sync_giftery_categories(giftery_categories):
+    rename = {'hobby': 'entertainment', 'accs': 'accesories'}
+    to_merge = {'spa': 'beauty', 'cafe': 'food', 'electronics': 'tech'}
+
+    giftery_cat = {}
+    giftery_slugs = {c.slug: c for c in Category.select()}
+    for cat in giftery_categories:
+        slug = cat['code'].lower()
+        if slug in ['new', 'popular', '']:
+            continue
+        slug = rename.get(slug, slug)
+        slug = to_merge.get(slug, slug)
+        mdl = giftery_slugs.get(slug)
+        if not mdl:
+            mdl = giftery_slugs[slug] = Category.create(
+                slug=slug,
+                title=cat['title'],
+                title_en=cat['title_en'])
+        giftery_cat[cat['id']] = mdl
+    return giftery_cat, giftery_slugs
+
+
+def giftery_shop_category(categories, giftery_slugs):
+    """ Shop in several categories goes to combined category ('<slug>,<slug>', hidden in spend list) """
+    slugs = sorted({c.slug for c in categories})
+    if len(slugs) == 1:
+        return giftery_slugs[slugs[0]]
+    final, _ = Category.get_or_create(
+        slug=','.join(slugs),
+        defaults={'title': giftery_slugs[slugs[0]].title, 'title_en': giftery_slugs[slugs[0]].title_en})
+    return final
+
+
+def sync_giftery(merchant, brand=None):
+    client = GifteryAPIClient()
+    giftery_categories, giftery_products = client.get_categories(), client.get_products()
+    with db.database.atomic():
+        _save_giftery(merchant, brand, giftery_categories, giftery_products)
+
+
+def _save_giftery(merchant, brand, giftery_categories, giftery_products):
+    giftery_cat, giftery_slugs = sync_giftery_categories(giftery_categories)
+
+    rows, images = [], {}
+    shop_mdls = {s.name: s for s in Shop.select().where(Shop.brand.is_null() & (Shop.merchant == merchant))}
+    for product in giftery_products:
+        shop = shop_mdls.get(product['title'])
+        if not shop:
+            shop = shop_mdls[product['title']] = Shop.create(
+                name=product['title'],
+                integrated=True,
+                active=True,
+                in_moderation=False,
+                merchant=merchant,
+                description=product['brief'],
+                brand=brand)
+        categories = list(filter(None, [giftery_cat.get(c_id) for c_id in product['categories']]))
+        if categories:
+            category = giftery_shop_category(categories, giftery_slugs)
+            if shop.category_id != category.id:
+                shop.category = category
+                shop.save()
+
+        slug = f"giftery-{product['id']}"
+        images[slug] = product['image_url']
+        faces = [int(price) for price in product['faces']]
+        if faces and faces[0] == 0:
+            price_kwargs = {
+                'price_fiat_min': int(product['face_min']),
+                'price_fiat_max': int(product['face_max']),
+                'price_fiat_step': int(product['face_step'])}
+        else:
+            price_kwargs = {'price_list_fiat': faces}
+        rows.append(product_row(
+            shop=shop.id, slug=slug, active=bool(faces), currency='RUB',
+            title=product['title'], description=product['disclaimer'], **price_kwargs))
+
+    created = sync_products('giftery-', rows)
+    for slug, product_id in created.items():
+        MerchantImage.create(product=product_id, url=images[slug])
+
+
+def sync_catalog(min_interval=None):
+    """
+    Pull all provider catalogs
+    :param min_interval: timedelta, skip sync if catalog was synced more recently
+    :return: False if catalog is being (or was recently) synced by another worker
+    """
+    # session lock, not a transaction: provider syncs commit separately while it's held
+    is_locked = db.database \
+        .execute_sql('SELECT pg_try_advisory_lock(%s)', (CATALOG_SYNC_LOCK_ID,)) \
+        .fetchone()[0]
+    if not is_locked:
+        return False
+    try:
+        synced = shared_cache.get_entry(CATALOG_SYNC_KEY)
+        if min_interval and synced and datetime.utcnow() - synced.updated_at < min_interval:
+            return False
+
+        with db.database.atomic():
+            admin = User.get(email='admin')
+            manual, _ = Merchant.get_or_create(user=admin)
+            gift, _ = Brand.get_or_create(name='GIFT', merchant=manual)
+            gratz, _ = Brand.get_or_create(name='Gratz', merchant=manual)
+
+        provider_syncs = [
+            ('Giftery', lambda: sync_giftery(manual)),
+            ('GIFT', lambda: sync_gift(manual, gift)),
+            ('Gratz', lambda: sync_gratz(manual, gratz))]
+        for provider, sync in provider_syncs:
+            try:
+                sync()
+            except Exception:
+                logging.exception(f'{provider} catalog sync failed')
+        shared_cache.put(CATALOG_SYNC_KEY, True)
+    finally:
+        db.database.execute_sql('SELECT pg_advisory_unlock(%s)', (CATALOG_SYNC_LOCK_ID,))
+    invalidate_spend_catalog()
+    return True
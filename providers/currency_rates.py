@@ -1,9 +1,13 @@
+import logging
+from time import time
 from typing import Dict
 
 import requests
-from cachetools.func import ttl_cache
 
-from helpers.misc import retry
+from helpers import shared_cache
+from helpers.metrics import metrics
+from helpers.shared_cache import SharedValue
+from providers.http import ProviderHTTP
 
 
 ONE_MINUTE = 60
@@ -14,38 +18,98 @@ RATES_API_BASE_URL = 'https://api.exchangeratesapi.io'
 PRIVAT24_API_BASE_URL = 'https://api.privatbank.ua/p24api'
 
 
-@ttl_cache(ttl=10 * ONE_MINUTE)
-@retry((requests.HTTPError, requests.Timeout), tries=3, delay=0.5, backoff=2, default={'bip2usdt': 0.01, 'usdt2bip': 0.01})
-def get_cfg():
-    r = requests.get(f'{MINTER1001_BASE_URL}/getcfg', timeout=1)
+RATES_CACHE_KEY = 'exchange-rates'
+RATES_REFRESH_INTERVAL = 5 * ONE_MINUTE
+
+minter1001_http = ProviderHTTP('minter1001', timeout=(1, 2))
+ecb_http = ProviderHTTP('ecb')
+privat24_http = ProviderHTTP('privat24')
+
+
+def fetch_cfg():
+    r = minter1001_http.get(f'{MINTER1001_BASE_URL}/getcfg')
     r.raise_for_status()
     return r.json()
 
 
-@ttl_cache(ttl=ONE_HOUR)
-@retry(requests.HTTPError, tries=3, delay=3, backoff=2)
-def ecb_usd_rates():
+def fetch_ecb_usd_rates():
     """European Central Bank rates"""
-    r = requests.get(f'{RATES_API_BASE_URL}/latest', params={'base': 'USD'})
+    r = ecb_http.get(f'{RATES_API_BASE_URL}/latest', params={'base': 'USD'})
     r.raise_for_status()
     return r.json()['rates']
 
 
-@ttl_cache(ttl=ONE_HOUR)
-@retry(requests.HTTPError, tries=3, delay=3, backoff=2)
-def privat24_usd_uah():
+def fetch_privat24_usd_uah():
     params = {
         'coursid': 5,
         'json': True,
         'exchange': True
     }
-    r = requests.get(f'{PRIVAT24_API_BASE_URL}/pubinfo', params=params)
+    r = privat24_http.get(f'{PRIVAT24_API_BASE_URL}/pubinfo', params=params)
     r.raise_for_status()
     rates_list = r.json()
     buy_rates = {rate['ccy']: float(rate['buy']) for rate in rates_list}
     return buy_rates.get('USD', 30)
 
 
+RATE_SOURCES = {
+    'cfg': fetch_cfg,
+    'ecb': fetch_ecb_usd_rates,
+    'privat24': fetch_privat24_usd_uah,
+}
+# used if source is down and there is no previous value
+RATE_DEFAULTS = {
+    'cfg': {'bip2usdt': 0.01, 'usdt2bip': 0.01},
+}
+
+
+def fetch_rates_snapshot(previous=None):
+    """ Fetch all rate sources. Source which is down keeps its value from previous snapshot """
+    previous = previous or {}
+    snapshot = {}
+    for name, fetch in RATE_SOURCES.items():
+        try:
+            snapshot[name] = fetch()
+        except (requests.RequestException, ValueError, KeyError) as exc:
+            if name not in previous and name not in RATE_DEFAULTS:
+                raise
+            logging.info(f'Rates source {name} unavailable, keeping previous value: {exc}')
+            snapshot[name] = previous.get(name, RATE_DEFAULTS.get(name))
+    snapshot['updated_at'] = time()
+    return snapshot
+
+
+def refresh_rates(max_age=RATES_REFRESH_INTERVAL):
+    """ Called by scheduler in every worker, so fresh enough snapshot is not refetched """
+    entry = shared_cache.get_entry(RATES_CACHE_KEY)
+    previous = entry.value if entry else None
+    if previous and time() - previous['updated_at'] < max_age:
+        return
+    shared_cache.put(RATES_CACHE_KEY, fetch_rates_snapshot(previous))
+
+
+# workers read rates only from the shared snapshot, external APIs are called by refresh_rates job
+# (or once, if there is no snapshot at all yet)
+rates_snapshot = SharedValue(RATES_CACHE_KEY, fetch_rates_snapshot, check_interval=30)
+
+
+def rates_age() -> float:
+    """ Seconds since the rates snapshot was fetched """
+    return time() - rates_snapshot.get()['updated_at']
+
+
+def get_cfg():
+    return rates_snapshot.get()['cfg']
+
+
+def ecb_usd_rates():
+    return rates_snapshot.get()['ecb']
+
+
+def privat24_usd_uah():
+    return rates_snapshot.get()['privat24']
+
+
 def bip_to_usdt(bip_value) -> float:
     if bip_value == 0:
         return 0
@@ -90,3 +154,14 @@ def rub_to_bip(value) -> float:
     bip2usdt_rate = float(cfg['bip2usdt'])
 
     return float(value / rub2usd_rate) / bip2usdt_rate
+
+
+def fiat_to_bip(value, currency) -> float:
+    if not value:
+        return 0
+    usd_rate = fiat_to_usd_rates()[currency]
+    bip2usdt_rate = float(get_cfg()['bip2usdt'])
+    return float(value) / usd_rate / bip2usdt_rate
+
+
+metrics.gauge('exchange_rates.age', rates_age)
@@ -1,14 +1,20 @@
 import requests
 
 from helpers.misc import retry
+from providers.http import ProviderHTTP
 
 EXPLORER_BASE_URL = 'https://explorer-api.minter.network/api/v1'
 DEFAULT_COIN_LIST = ["ROUBLE", "DICE", "TIME", "UNUCOIN", "PIZZA", "POPE"]
 
+explorer_http = ProviderHTTP('explorer')
 
-@retry((requests.HTTPError, requests.Timeout), tries=3, delay=0.2, backoff=3, default=DEFAULT_COIN_LIST)
+
+# requests are retried by explorer_http, fallback to default list if explorer is down
+@retry(requests.RequestException, tries=2, delay=0, default=DEFAULT_COIN_LIST)
 def get_coins():
-    return requests.get(f'{EXPLORER_BASE_URL}/coins').json()['data']
+    r = explorer_http.get(f'{EXPLORER_BASE_URL}/coins')
+    r.raise_for_status()
+    return r.json()['data']
 
 
 def get_custom_coin_symbols():
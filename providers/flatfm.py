@@ -1,20 +1,21 @@
-import requests
-
 from api.models import PushWallet
+from providers.http import ProviderHTTP
 from providers.minter import send_coins
 
 FLATFM_BASE_URL = 'https://flat.audio/api/'
 
+flatfm_http = ProviderHTTP('flatfm')
+
 
-def flatfm_top_up(wallet: PushWallet, amount, profile):
+def flatfm_top_up(wallet: PushWallet, amount, profile, ctx=None):
     profile = profile.strip()
-    r = requests.post(f'{FLATFM_BASE_URL}/users/wallet/address', json={'user_id': profile})
+    r = flatfm_http.post(f'{FLATFM_BASE_URL}/users/wallet/address', json={'user_id': profile}, idempotent=True)
     response = r.json()
     if 'address' not in response:
         return response.get('error', {}).get('reason', f'Flat.audio profile "{profile}" not found')
 
-    result = send_coins(wallet, response['address'], amount, wait=True)
+    result = send_coins(wallet, response['address'], amount, wait=False, ctx=ctx)
     if isinstance(result, str):
         return result
 
-    return True
+    return {'tx': result.to_dict()}
@@ -1,39 +1,20 @@
 import logging
-from time import sleep
 
-import requests
 from shortuuid import uuid
 
-from api.models import WebhookEvent, OrderHistory
+from api.models import WebhookEvent, OrderHistory, Product
+from helpers.pg_notify import PgListener, notify
 from mintersdk.shortcuts import to_pip
+from providers.http import ProviderHTTP
 from providers.minter import send_coins
 
 GIFT_WEBHOOK_URL = 'https://push.money/webhooks/gift/{}'
 GIFT_API_BASE_URL = 'http://minterfood.ru/miniapi/create_pay.php'
+GIFT_WEBHOOK_CHANNEL = 'gift_webhook'
+GIFT_CONFIRM_TIMEOUT = 10
 
-
-def gift_product_list():
-
-    good = []
-    ya_food = ['y1000', 'y2000', 'y3000']
-    for product in ya_food:
-        response = gift_order_create(product)
-        if isinstance(response, dict):
-            good.append(product)
-        else:
-            print(response)
-
-    return {
-        'food': {
-            'Яндекс.Еда (GIFT)': [
-                {
-                    'option': f'gift-{p}',
-                    'value': int(p[1:]),
-                    'currency': 'RUB',
-                    'available': p in good
-                } for p in ya_food]
-        }
-    }, {'option': 'gift-t1', 'value': 1, 'currency': 'BIP'}
+gift_webhooks = PgListener(GIFT_WEBHOOK_CHANNEL)
+gift_http = ProviderHTTP('gift')
 
 
 def gift_order_create(product):
@@ -42,7 +23,7 @@ def gift_order_create(product):
         'product': product,
         'webhook': GIFT_WEBHOOK_URL.format(order_id)
     }
-    r = requests.post(GIFT_API_BASE_URL, data=payload)
+    r = gift_http.post(GIFT_API_BASE_URL, data=payload)
     r.raise_for_status()
     data = r.json()
     if not data.get('address'):
@@ -55,29 +36,45 @@ def gift_order_create(product):
     }
 
 
-def gift_order_confirm(order_id):
-    max_tries = 20
-    tries = 0
-    while tries <= max_tries:
-        sleep(0.2)
-        event = WebhookEvent.get_or_none(event_id=order_id)
-        if not event:
-            tries += 1
-            continue
-        code = event.event_data['code']
-        event.delete()
-        return {'code': code}
-    return 'Gift Provider Error: No payment confirmation'
+def gift_product_unavailable(product):
+    """ Hide product which can't be ordered, catalog sync shows it again (see providers.catalog) """
+    # local import: api.logic.core imports providers
+    from api.logic.core import invalidate_spend_catalog
+    Product.update(active=False).where(Product.slug == f'gift-{product}').execute()
+    invalidate_spend_catalog()
+
+
+def gift_order_status(order_id):
+    event = WebhookEvent.get_or_none(provider='gift', event_id=order_id)
+    if not event:
+        return {'status': 'pending', 'order_id': order_id}
+    return {'status': 'confirmed', 'order_id': order_id, 'code': event.event_data['code']}
+
+
+def gift_order_confirm(order_id, timeout=GIFT_CONFIRM_TIMEOUT):
+    """
+    Wait for the provider webhook (it may be received by any worker).
+    If it doesn't come in time, order stays pending: see /api/spend/gift/<order_id>
+    """
+    with gift_webhooks.subscribe(order_id) as webhook_received:
+        status = gift_order_status(order_id)
+        if status['status'] == 'pending' and webhook_received.wait(timeout):
+            status = gift_order_status(order_id)
+    if status['status'] == 'pending':
+        return status
+    return {'code': status['code']}
 
 
-def gift_buy(wallet, product, confirm=True, price_fiat=None):
-    response = gift_order_create(product)
+def gift_buy(wallet, product, confirm=True, price_fiat=None, ctx=None, quote=None):
+    response = quote or gift_order_create(product)
     if isinstance(response, str):
+        logging.info(f'GIFT product {product} not available: {response}')
+        gift_product_unavailable(product)
         return response
     price_bip = response['price_bip']
 
     if not confirm:
-        return {'price_bip': price_bip}
+        return {'price_bip': price_bip, 'quote': response}
 
     OrderHistory.create(
         provider='gift',
@@ -86,7 +83,7 @@ def gift_buy(wallet, product, confirm=True, price_fiat=None):
         address_from=wallet.address,
         address_to=response['address'])
 
-    result = send_coins(wallet, to=response['address'], amount=price_bip, wait=True)
+    result = send_coins(wallet, to=response['address'], amount=price_bip, wait=True, ctx=ctx)
     if isinstance(result, str):
         return result
 
@@ -97,3 +94,4 @@ def gift_webhook_controller(request, order_id):
     logging.info(request.form)
     code = request.form['code']
     WebhookEvent.create(provider='gift', event_id=order_id, event_data={'code': code})
+    notify(GIFT_WEBHOOK_CHANNEL, order_id)
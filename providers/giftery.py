@@ -2,7 +2,6 @@ import hashlib
 import logging
 from time import sleep
 
-import requests
 import typing
 
 from urllib.parse import urlencode
@@ -13,10 +12,15 @@ from api.models import PushWallet, OrderHistory
 from config import BIP_WALLET, GIFTERY_API_ID, GIFTERY_API_SECRET, DEV, GIFTERY_TEST_API, DEV_GIFTERY_API_SECRET, \
     DEV_GIFTERY_API_ID
 from providers.currency_rates import rub_to_bip
-from providers.minter import send_coins
+from providers.http import ProviderHTTP
+from providers.minter import send_coins, SpendContext
 
 
 BASE_URL = 'https://ssl-api.giftery.ru/'
+# commands which must not be repeated if request reached the provider
+UNSAFE_COMMANDS = ['makeOrder']
+
+giftery_http = ProviderHTTP('giftery', timeout=(3, 20))
 
 
 class GifteryAPIException(Exception):
@@ -73,7 +77,7 @@ class GifteryAPIClient:
             'in': 'json'
         }
 
-        resp = requests.get(BASE_URL, params=urlencode(params))
+        resp = giftery_http.get(BASE_URL, params=urlencode(params), idempotent=cmd not in UNSAFE_COMMANDS)
         if not resp or resp.json()['status'] != 'ok':
             err = resp.json()['error']
             raise GifteryAPIException(err['text'], err['code'])
@@ -213,11 +217,19 @@ class GifteryAPIClient:
         return resp_data['data']
 
 
-def giftery_buy(wallet: PushWallet, product: int, price_fiat: int, contact: str = None, confirm: bool = True):
-    price_bip = 0 if DEV else rub_to_bip(price_fiat)
+def giftery_buy(
+        wallet: PushWallet, product: int, price_fiat: int, contact: str = None, confirm: bool = True,
+        ctx: SpendContext = None, quote: dict = None):
+    if quote:
+        # order exactly what was quoted
+        product, price_fiat, price_bip = quote['product'], quote['price_fiat'], quote['price_bip']
+    else:
+        price_bip = 0 if DEV else rub_to_bip(price_fiat)
 
     if not confirm:
-        return {'price_bip': price_bip}
+        return {
+            'price_bip': price_bip,
+            'quote': {'product': product, 'price_fiat': price_fiat, 'price_bip': price_bip}}
 
     client = GifteryAPIClient(test=DEV)
 
@@ -241,7 +253,7 @@ def giftery_buy(wallet: PushWallet, product: int, price_fiat: int, contact: str
         return 'Product sold out :('
 
     if not DEV:
-        result = send_coins(wallet, to=BIP_WALLET, amount=price_bip, wait=True)
+        result = send_coins(wallet, to=BIP_WALLET, amount=price_bip, wait=True, ctx=ctx)
         if isinstance(result, str):
             return result
 
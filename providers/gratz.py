@@ -1,16 +1,17 @@
 import logging
 
-import requests
-from cachetools.func import ttl_cache
+from peewee import JOIN
 
-from api.models import OrderHistory
+from api.models import OrderHistory, Product, Shop, Category
 from config import GRATZ_API_KEY
 from jobs import schedule_gratz_notification
 from mintersdk.shortcuts import to_pip
+from providers.http import ProviderHTTP
 from providers.minter import send_coins
 
 GRATZ_API_BASE_URL = 'https://gratz-bot.click.in.ua/api'
 GRATZ_HACK_HEADERS = {'user-agent': 'hack'}  # HTTP 424 if use python std headers :)
+gratz_http = ProviderHTTP('gratz', headers=GRATZ_HACK_HEADERS)
 
 CATEGORY_ID_MAPPING = {
     '11': 'entertainment',
@@ -24,11 +25,10 @@ CATEGORY_ID_MAPPING = {
 }
 
 
-@ttl_cache(ttl=10 * 60)
 def gratz_product_list():
-    r = requests.post(
+    r = gratz_http.post(
         f'{GRATZ_API_BASE_URL}/list.php',
-        data={'key': GRATZ_API_KEY}, headers=GRATZ_HACK_HEADERS)
+        data={'key': GRATZ_API_KEY}, idempotent=True)
     r.raise_for_status()
     data = r.json()
     if 'error' in data:
@@ -63,9 +63,9 @@ def gratz_product_list():
 
 
 def gratz_order_create(product_id):
-    r = requests.post(
+    r = gratz_http.post(
         f'{GRATZ_API_BASE_URL}/buy.php',
-        data={'key': GRATZ_API_KEY, 'id': product_id}, headers=GRATZ_HACK_HEADERS)
+        data={'key': GRATZ_API_KEY, 'id': product_id})
     r.raise_for_status()
     data = r.json()
     if 'error' in data:
@@ -78,25 +78,25 @@ def gratz_order_create(product_id):
 
 
 def gratz_order_confirm(order_id):
-    r = requests.post(
+    r = gratz_http.post(
         f'{GRATZ_API_BASE_URL}/check.php',
-        data={'key': GRATZ_API_KEY, 'id': order_id}, headers=GRATZ_HACK_HEADERS)
+        data={'key': GRATZ_API_KEY, 'id': order_id}, idempotent=True)
     r.raise_for_status()
     data = r.json()
     return data
 
 
-def gratz_buy(wallet, product, confirm=True, contact=None, price_fiat=None):
+def gratz_buy(wallet, product, confirm=True, contact=None, price_fiat=None, ctx=None, quote=None):
     logging.info(f'Buy gratz product id {product}')
-    response = gratz_order_create(product)
+    response = quote or gratz_order_create(product)
     if isinstance(response, str):
         return response
     logging.info(f'  order create response {response}')
 
     price_bip = response['price_bip']
     if not confirm:
-        return {'price_bip': price_bip}
-    result = send_coins(wallet, to=response['address'], amount=price_bip, wait=True)
+        return {'price_bip': price_bip, 'quote': response}
+    result = send_coins(wallet, to=response['address'], amount=price_bip, wait=True, ctx=ctx)
     if isinstance(result, str):
         return result
 
@@ -120,12 +120,14 @@ def gratz_buy(wallet, product, confirm=True, contact=None, price_fiat=None):
 
 
 def get_full_product_name(product):
-    p_list, test = gratz_product_list()
-    if int(product) == int(test['option'].split('-')[1]):
-        return 'Test product', 'Test shop', 1
-    for cat, shops in p_list.items():
-        for shop, products in shops.items():
-            for obj in products:
-                product_id = obj['option'].split('-')[1]
-                if int(product_id) == int(product):
-                    return cat, shop, product['value']
+    """ Category, shop and value of Gratz product from synced catalog (see providers.catalog) """
+    found = Product \
+        .select(Category.slug.alias('category'), Shop.name.alias('shop'), Product.price_fiat) \
+        .join(Shop) \
+        .join(Category, JOIN.LEFT_OUTER) \
+        .where(Product.slug == f'gratz-{product}') \
+        .dicts() \
+        .first()
+    if not found:
+        return 'Unknown category', 'Unknown shop', None
+    return found['category'], found['shop'], found['price_fiat']
@@ -0,0 +1,143 @@
+"""
+HTTP client for partner APIs (shops, top-ups, exchange rates), one ProviderHTTP per provider:
+   - own requests.Session per process (keep-alive, bounded connection pool)
+   - connect/read timeouts on every request, so slow partner can't hang a worker
+   - bounded retries: requests which never reached the provider (connect timeout) are always retried,
+     timeouts, connection errors and 5xx only for idempotent requests (GET by default)
+   - circuit breaker: after CIRCUIT_FAILURES failed requests (with all retries) in a row
+     provider is not called for CIRCUIT_RESET seconds
+   - latency histogram and error counters (every attempt) per provider (provider_http.<name>)
+
+Responses are returned as is, callers check status with raise_for_status() as with plain requests.
+"""
+import os
+from threading import Lock
+from time import monotonic, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from helpers.metrics import metrics
+
+DEFAULT_TIMEOUT = (3, 10)  # connect, read
+DEFAULT_RETRIES = 2
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET = 30
+
+_providers = {}
+
+
+class ProviderUnavailable(requests.RequestException):
+    """ Circuit is open, provider wasn't called """
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failures` failed requests in a row, requests fail fast while open.
+    In `reset_after` seconds one trial request is let through (half-open): success closes the circuit,
+    failure opens it again.
+    """
+
+    def __init__(self, failures=CIRCUIT_FAILURES, reset_after=CIRCUIT_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._failed = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'open' if monotonic() - self._opened_at < self.reset_after else 'half-open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            self._trial = False
+            if success:
+                self._failed, self._opened_at = 0, None
+                return
+            self._failed += 1
+            if self._opened_at is not None or self._failed >= self.failures:
+                self._opened_at = monotonic()
+
+
+class ProviderHTTP:
+
+    def __init__(
+            self, name, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=0.5,
+            pool_size=4, headers=None):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self.circuit = CircuitBreaker()
+        self._session = None
+        self._session_pid = None
+        _providers[name] = self
+
+    @property
+    def session(self):
+        # gunicorn forks workers: every process should have its own connections
+        if self._session is None or self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(self.headers)
+            self._session, self._session_pid = session, os.getpid()
+        return self._session
+
+    def request(self, method, url, idempotent=None, timeout=None, **kwargs):
+        """
+        :param idempotent: request may be safely repeated if provider got it, GET by default
+        :raises ProviderUnavailable: circuit is open
+        :raises requests.RequestException: request failed after all retries
+        """
+        idempotent = method.upper() == 'GET' if idempotent is None else idempotent
+        # circuit counts logical requests: retries of one call are a single success or failure
+        if not self.circuit.allow():
+            metrics.incr(f'provider_http.{self.name}.rejected')
+            raise ProviderUnavailable(f'Provider {self.name} is temporarily unavailable')
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timer(f'provider_http.{self.name}'):
+                    response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.RequestException as exc:
+                metrics.incr(f'provider_http.{self.name}.errors')
+                can_retry = isinstance(exc, requests.ConnectTimeout) or (
+                    idempotent and isinstance(exc, (requests.ConnectionError, requests.Timeout)))
+                if not can_retry or attempt == self.retries:
+                    self.circuit.record(success=False)
+                    raise
+            else:
+                if response.status_code < 500:
+                    self.circuit.record(success=True)
+                    return response
+                metrics.incr(f'provider_http.{self.name}.errors')
+                if not idempotent or attempt == self.retries:
+                    self.circuit.record(success=False)
+                    return response
+            sleep(self.backoff * 2 ** attempt)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+metrics.gauge('provider_http.circuits', lambda: {name: p.circuit.state for name, p in _providers.items()})
@@ -1,23 +1,73 @@
-from mintersdk.sdk.wallet import MinterWallet
+from datetime import datetime, timedelta
 
-from api.models import PushWallet
+from peewee import fn
+
+from api.models import PushWallet, WalletNonce, PendingPayout, db
 from helpers.misc import truncate
-from minter.tx import send_coin_tx
-from mintersdk.shortcuts import to_bip
-from minter.helpers import effective_balance, find_gas_coin
+from minter.api import MinterAPIException, TxConfirmationTimeout
+from minter.tx import send_coin_tx, estimate_custom_fee
+from mintersdk.shortcuts import to_bip, to_pip
+from minter.consts import BASE_COIN, TX_TRACK_TTL
+from minter.helpers import valuate_balances
+from minter.keys import get_private_key
 from providers.nodeapi import NodeAPI
 
+NONCE_ALLOCATE_SQL = f'''
+    INSERT INTO {WalletNonce._meta.table_name} (address, nonce, updated_at) VALUES (%s, %s, now())
+    ON CONFLICT (address) DO UPDATE
+    SET nonce = GREATEST({WalletNonce._meta.table_name}.nonce + 1, EXCLUDED.nonce), updated_at = now()
+    RETURNING nonce
+'''
+
+
+class SpendContext:
+    """
+    Wallet state for one spend request, shared by spend_balance and the provider it calls.
+
+    Balance (with transaction_count for the nonce) is fetched on first use, valuation
+    and gas coin are resolved once per payload, so checking and sending don't ask node twice.
+    """
+
+    def __init__(self, wallet: PushWallet):
+        self.wallet = wallet
+        self._response = None
+        self._valuations = {}
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = NodeAPI.get_balance(self.wallet.address)
+        return self._response
+
+    @property
+    def balances(self):
+        return self.response['balance']
+
+    @property
+    def transaction_count(self):
+        return self.response['transaction_count']
 
-def send_coins(wallet: PushWallet, to=None, amount=None, payload='', wait=True, gas_coin=None):
-    private_key = MinterWallet.create(mnemonic=wallet.mnemonic)['private_key']
-    response = NodeAPI.get_balance(wallet.address)
-    nonce = int(response['transaction_count']) + 1
-    balances = response['balance']
-    balances_bip = effective_balance(balances)
-    main_coin, main_balance_bip = max(balances_bip.items(), key=lambda i: i[1])
+    def valuation(self, payload=''):
+        if payload not in self._valuations:
+            self._valuations[payload] = valuate_balances(self.balances, payload=payload)
+        return self._valuations[payload]
+
+    def gas(self, payload=''):
+        return self.valuation(payload).gas
+
+    @property
+    def private_key(self):
+        return get_private_key(self.wallet)
+
+
+def send_coins(wallet: PushWallet, to=None, amount=None, payload='', wait=True, gas_coin=None, ctx=None):
+    ctx = ctx or SpendContext(wallet)
+    balances = ctx.balances
+    valuation = ctx.valuation(payload)
+    main_coin = valuation.main_coin
     main_balance = float(to_bip(balances[main_coin]))
 
-    gas_coin, tx_fee = find_gas_coin(balances, get_fee=True, payload=payload)
+    gas_coin, tx_fee = valuation.gas
     gas_coin_balance = float(to_bip(balances.get(gas_coin, 0)))
 
     if not gas_coin or not tx_fee or gas_coin_balance < tx_fee:
@@ -30,9 +80,113 @@ def send_coins(wallet: PushWallet, to=None, amount=None, payload='', wait=True,
     tx_fee = tx_fee if gas_coin == main_coin else 0
     if amount > main_balance - tx_fee:
         return 'Not enough balance'
-    tx = send_coin_tx(private_key, main_coin, amount, to, nonce, payload=payload, gas_coin=gas_coin)
-    NodeAPI.send_tx(tx, wait=wait)
-    return True
+    private_key = ctx.private_key
+    try:
+        return send_tx_pipelined(
+            wallet.address,
+            lambda nonce: send_coin_tx(private_key, main_coin, amount, to, nonce, payload=payload, gas_coin=gas_coin),
+            transaction_count=ctx.transaction_count, wait=wait)
+    except MinterAPIException as exc:
+        return exc.message
+
+
+def allocate_nonce(address, transaction_count=None):
+    """
+    Next nonce for a hot wallet (campaign, reward campaign, any wallet sending often).
+
+    Last allocated nonce is stored in DB and incremented atomically, so concurrent payouts
+    from one wallet get sequential nonces and may land in the same block.
+    Node's transaction_count wins when it's ahead of the local counter (tx sent from elsewhere).
+    """
+    if transaction_count is None:
+        transaction_count = NodeAPI.get_balance(address)['transaction_count']
+    cursor = db.database.execute_sql(NONCE_ALLOCATE_SQL, (address, int(transaction_count) + 1))
+    return cursor.fetchone()[0]
+
+
+def reset_nonce(address):
+    """ Forget local counter, next allocation starts from node's transaction_count """
+    WalletNonce.delete().where(WalletNonce.address == address).execute()
+
+
+def send_tx_pipelined(address, make_tx, transaction_count=None, callback=None, **send_kwargs):
+    """
+    Sign tx with locally allocated nonce (make_tx: nonce -> signed tx) and send it.
+    Counter is reconciled with node when tx is rejected or never gets into a block.
+    callback(pending) is called when tx is resolved (from TxTracker thread)
+    """
+    def reconcile(pending):
+        with db.database.connection_context():
+            if pending.status == 'expired':
+                reset_nonce(address)
+            if callback:
+                callback(pending)
+
+    nonce = allocate_nonce(address, transaction_count=transaction_count)
+    try:
+        return NodeAPI.send_tx(make_tx(nonce), callback=reconcile, **send_kwargs)
+    except TxConfirmationTimeout:
+        raise
+    except MinterAPIException:
+        reset_nonce(address)
+        raise
+
+
+def reserved_payouts_query(source_address, coin, balance_at=None):
+    recently_sent = (PendingPayout.status == 'sent') & \
+        (PendingPayout.sent_at > datetime.utcnow() - timedelta(seconds=TX_TRACK_TTL))
+    reserved = PendingPayout.status.in_(['pending', 'sending']) | recently_sent
+    if balance_at:
+        reserved |= (PendingPayout.status == 'confirmed') & (PendingPayout.confirmed_at >= balance_at)
+    return PendingPayout \
+        .select(fn.SUM(PendingPayout.amount_pip.cast('numeric') + PendingPayout.fee_pip.cast('numeric'))) \
+        .where((PendingPayout.source_address == source_address) & (PendingPayout.coin == coin) & reserved)
+
+
+def reserved_payouts_pip(source_address, coin, balance_at=None):
+    """
+    Sum of payouts (with multisend commission) from the wallet which are not reflected in node balance yet
+    :param balance_at: when node balance was requested, payouts confirmed later may be missing in it
+    """
+    return int(reserved_payouts_query(source_address, coin, balance_at=balance_at).scalar() or 0)
+
+
+class PayoutSource:
+    """
+    Hot wallet state for enqueue_payout.
+
+    Node balance and commission are fetched when source is created, before the reserving transaction,
+    so neither the reservation lock nor row locks held by the caller wait for the node.
+    """
+
+    def __init__(self, address, coin=BASE_COIN):
+        self.address = address
+        self.coin = coin
+        self.balance_at = datetime.utcnow()
+        self.balance_pip = int(NodeAPI.get_balance(address)['balance'].get(coin, 0))
+        # multisend commission per recipient is less than the fee of a single send
+        self.fee_pip = int(to_pip(estimate_custom_fee(coin) or 0))
+
+    @property
+    def available_pip(self):
+        return self.balance_pip - reserved_payouts_pip(self.address, self.coin, balance_at=self.balance_at)
+
+
+def enqueue_payout(source: PayoutSource, to, amount):
+    """
+    Transfer which will be sent from source wallet in the next multisend batch (see jobs.payouts).
+    Amount and commission are reserved: payouts waiting in queue are counted against the wallet balance.
+    :return: PendingPayout or error message if balance is not enough
+    """
+    amount_pip = int(to_pip(amount))
+    with db.database.atomic():
+        # reservations from one wallet are serialized, lock is released with transaction
+        db.database.execute_sql('SELECT pg_advisory_xact_lock(hashtext(%s))', (source.address,))
+        if source.available_pip < amount_pip + source.fee_pip:
+            return 'Not enough balance'
+        return PendingPayout.create(
+            source_address=source.address, to=to.strip(), coin=source.coin,
+            amount_pip=str(amount_pip), fee_pip=str(source.fee_pip))
 
 
 def get_balance(address, coin='BIP', bip=True):
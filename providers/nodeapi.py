@@ -1,9 +1,16 @@
-from config import MSCAN_APIKEY, TESTNET, NODE_API, FUNFASY_PROJECT_ID, FUNFASY_PROJECT_SECRET
+from config import MSCAN_APIKEY, TESTNET, NODE_API, FUNFASY_PROJECT_ID, FUNFASY_PROJECT_SECRET, NODE_API_POOL_SIZE, \
+    NODE_API_CONNECT_TIMEOUT, NODE_API_READ_TIMEOUT
+from helpers.metrics import metrics
 from minter.api import CustomMinterAPI
 
 MSCAN_URL = f'https://api.mscan.dev/{MSCAN_APIKEY}/{"test_node" if TESTNET else "node"}'
 FUNFASY_URL = 'https://mnt.funfasy.dev/v0/'
-NodeAPI = CustomMinterAPI(MSCAN_URL if NODE_API == 'mscan' else FUNFASY_URL, headers={
-    'X-Project-Id': FUNFASY_PROJECT_ID,
-    'X-Project-Secret': FUNFASY_PROJECT_SECRET
-})
+NodeAPI = CustomMinterAPI(
+    MSCAN_URL if NODE_API == 'mscan' else FUNFASY_URL,
+    pool_size=NODE_API_POOL_SIZE,
+    timeout=(NODE_API_CONNECT_TIMEOUT, NODE_API_READ_TIMEOUT),
+    headers={
+        'X-Project-Id': FUNFASY_PROJECT_ID,
+        'X-Project-Secret': FUNFASY_PROJECT_SECRET
+    })
+metrics.gauge('tx_tracker.pending', lambda: NodeAPI.tracker.pending_count)
@@ -10,7 +10,7 @@ TIMELOOP_ADDRESS = 'Mx3650064486380210127159872871912061022891'
 BIPGAME_ADDRESS = 'Mxc938ac4123503aa691ff106ce98f732fae0f01b3'
 
 
-def timeloop_top_up(wallet: PushWallet, amount):
+def timeloop_top_up(wallet: PushWallet, amount, ctx=None):
     gift_code = uuid()
     h = hashlib.sha256()
     h.update(gift_code.encode('utf-8'))
@@ -20,14 +20,14 @@ def timeloop_top_up(wallet: PushWallet, amount):
     if amount_fact <= 0:
         return 'Amount is too low'
 
-    result = send_coins(wallet, TIMELOOP_ADDRESS, amount_fact, payload=payload, wait=True)
+    result = send_coins(wallet, TIMELOOP_ADDRESS, amount_fact, payload=payload, wait=False, ctx=ctx)
     if isinstance(result, str):
         return result
 
-    return {'link': f'https://timeloop.games/?gift={gift_code}'}
+    return {'link': f'https://timeloop.games/?gift={gift_code}', 'tx': result.to_dict()}
 
 
-def bipgame_top_up(wallet: PushWallet, amount):
+def bipgame_top_up(wallet: PushWallet, amount, ctx=None):
     gift_code = uuid()
     h = hashlib.sha256()
     h.update(gift_code.encode('utf-8'))
@@ -37,8 +37,8 @@ def bipgame_top_up(wallet: PushWallet, amount):
     if amount_fact <= 0:
         return 'Amount is too low'
 
-    result = send_coins(wallet, BIPGAME_ADDRESS, amount_fact, payload=payload, wait=True)
+    result = send_coins(wallet, BIPGAME_ADDRESS, amount_fact, payload=payload, wait=False, ctx=ctx)
     if isinstance(result, str):
         return result
 
-    return {'link': f'https://bipgame.io/public/push?gift={gift_code}'}
+    return {'link': f'https://bipgame.io/public/push?gift={gift_code}', 'tx': result.to_dict()}
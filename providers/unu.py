@@ -1,30 +1,31 @@
-import requests
-
 from api.models import PushWallet
 from config import UNU_API_KEY
+from providers.http import ProviderHTTP
 from providers.minter import send_coins
 
 UNU_BASE_URL = 'https://unu.ru/api'
 
+unu_http = ProviderHTTP('unu')
+
 
-def unu_top_up(wallet: PushWallet, amount, email=None):
+def unu_top_up(wallet: PushWallet, amount, email=None, ctx=None):
     email = email.strip()
     if not email:
         return 'Email not specified'
 
-    r = requests.post(UNU_BASE_URL, data={
+    r = unu_http.post(UNU_BASE_URL, data={
         'api_key': UNU_API_KEY,
         'action': 'get_minter_wallet',
         'email': email
-    })
+    }, idempotent=True)
     r.raise_for_status()
     response = r.json()
 
     if response['errors']:
         return response['errors']
 
-    result = send_coins(wallet, response['wallet'], amount, wait=True)
+    result = send_coins(wallet, response['wallet'], amount, wait=False, ctx=ctx)
     if isinstance(result, str):
         return result
 
-    return True
+    return {'tx': result.to_dict()}